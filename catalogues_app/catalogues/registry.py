@@ -0,0 +1,181 @@
+"""
+In-process snapshots of the reference tables.
+
+Countries and eye colors are tiny and rarely change, so every process
+keeps them in memory: an immutable Snapshot per table holds the rows by id
+and their serialized representations, replaced as a whole on refresh.
+
+A background thread refreshes the snapshots. On PostgreSQL it LISTENs on
+NOTIFY_CHANNEL, which writes through the viewsets notify, and reloads the
+named table right away. Every CATALOGUE_REFRESH_INTERVAL seconds (and on
+other backends, or while the listening connection is broken) all tables
+are reloaded regardless.
+"""
+
+import hashlib
+import logging
+import os
+import select
+import threading
+import time
+from types import MappingProxyType
+
+from django.conf import settings
+from sqlalchemy import text
+
+from sa_helper import get_engine
+from sa_helper.read_serializers import compile_read_serializer
+
+NOTIFY_CHANNEL = 'catalogues_changed'
+# Hosts whose representations a snapshot keeps, URLs in them are absolute
+MAX_RENDERED_HOSTS = 8
+
+logger = logging.getLogger(__name__)
+
+
+class Snapshot:
+    """
+    Immutable rows of a table, by id and in id order. The token is a hash
+    of the rows, equal in every process loading the same content.
+    """
+
+    def __init__(self, rows):
+        self.rows = tuple(rows)
+        self.by_id = MappingProxyType({str(row.id): row for row in self.rows})
+        self.token = hashlib.md5(repr([tuple(row) for row in self.rows]).encode('utf-8')).hexdigest()
+        self._rendered = {}
+
+    def etag(self, request):
+        variant = '{}:{}:{}'.format(self.token, request.build_absolute_uri('/'),
+                                    request.accepted_media_type)
+        return '"{}"'.format(hashlib.md5(variant.encode('utf-8')).hexdigest())
+
+    def rendered(self, serializer_class, request):
+        """
+        Returns (list representation, {id: representation}) for request's host
+        """
+        prefix = request.build_absolute_uri('/')
+        rendered = self._rendered.get(prefix)
+        if rendered is None:
+            to_representation = compile_read_serializer(serializer_class, {'request': request})
+            items = tuple(to_representation(row) for row in self.rows)
+            rendered = (items, MappingProxyType({str(row.id): item
+                                                 for row, item in zip(self.rows, items)}))
+            if len(self._rendered) >= MAX_RENDERED_HOSTS:
+                self._rendered = {}
+            self._rendered[prefix] = rendered
+        return rendered
+
+
+class ReferenceRegistry:
+
+    def __init__(self):
+        self._models = {}
+        self._snapshots = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def register(self, model):
+        self._models[model.__tablename__] = model
+
+    @property
+    def interval(self):
+        return getattr(settings, 'CATALOGUE_REFRESH_INTERVAL', 60)
+
+    def snapshot(self, model):
+        """
+        Returns the table's current snapshot, loading it on first use
+        """
+        self._ensure_refresher()
+        snapshot = self._snapshots.get(model.__tablename__)
+        if snapshot is None:
+            snapshot = self.refresh(model.__tablename__)
+        return snapshot
+
+    def refresh(self, table_name):
+        """
+        Reloads a table, keeping the current snapshot (and its rendered
+        representations) if the rows didn't change
+        """
+        table = self._models[table_name].__table__
+        # Own connection, callers' sessions may be read-only or mid-transaction
+        with get_engine().connect() as connection:
+            rows = connection.execute(table.select().order_by(table.c.id)).fetchall()
+        snapshot = Snapshot(rows)
+        current = self._snapshots.get(table_name)
+        if current is not None and current.token == snapshot.token:
+            return current
+        self._snapshots[table_name] = snapshot
+        return snapshot
+
+    def refresh_all(self):
+        for table_name in list(self._models):
+            self.refresh(table_name)
+
+    def changed(self, model):
+        """
+        Reloads a table written by this process and tells the other ones.
+        Failures are logged only: the write is committed, and the periodic
+        refresh picks it up.
+        """
+        try:
+            self.refresh(model.__tablename__)
+            engine = get_engine()
+            if engine.url.get_backend_name() != 'postgresql':
+                return
+            notify = text('SELECT pg_notify(:channel, :table_name)').execution_options(autocommit=True)
+            with engine.connect() as connection:
+                connection.execute(notify, channel=NOTIFY_CHANNEL, table_name=model.__tablename__)
+        except Exception:
+            logger.exception('Announcing a change of %s failed', model.__tablename__)
+
+    def _ensure_refresher(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            # Snapshots inherited through fork() may be stale, the thread isn't
+            self._snapshots = {}
+            thread = threading.Thread(target=self._run, name='catalogue-refresher', daemon=True)
+            thread.start()
+            self._pid = pid
+
+    def _run(self):
+        while True:
+            try:
+                if get_engine().url.get_backend_name() == 'postgresql':
+                    self._listen()
+                else:
+                    time.sleep(self.interval)
+                    self.refresh_all()
+            except Exception:
+                logger.exception('Refreshing catalogue snapshots failed')
+                time.sleep(self.interval)
+
+    def _listen(self):
+        connection = get_engine().raw_connection()
+        # Never returned to the pool, it stays in LISTEN mode
+        connection.detach()
+        dbapi_connection = connection.connection
+        try:
+            dbapi_connection.autocommit = True
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute('LISTEN {}'.format(NOTIFY_CHANNEL))
+            # Changes made while no one was listening
+            self.refresh_all()
+            while True:
+                if select.select([dbapi_connection], [], [], self.interval) == ([], [], []):
+                    self.refresh_all()
+                    continue
+                dbapi_connection.poll()
+                table_names = {notify.payload for notify in dbapi_connection.notifies}
+                del dbapi_connection.notifies[:]
+                for table_name in table_names & set(self._models):
+                    self.refresh(table_name)
+        finally:
+            dbapi_connection.close()
+
+
+registry = ReferenceRegistry()
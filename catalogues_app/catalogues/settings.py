@@ -48,8 +48,11 @@ REST_FRAMEWORK = {
 
 
 MIDDLEWARE = [
+    'sa_helper.lifecycle.SASessionMiddleware',
 ]
 
+# DummyCache stores nothing: the viewsets' read cache (read_cache_timeout,
+# see sa_helper.read_cache) only caches with settings_docker's memcached
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
@@ -77,6 +80,19 @@ WSGI_APPLICATION = 'catalogues.wsgi.application'
 
 SA_DATABASE_URL = 'sqlite:///{}'.format(os.path.join(BASE_DIR,'foo.db'))
 
+# Keyword arguments for sqlalchemy.create_engine() of the per-process engine,
+# plus 'statement_timeout' (ms, PostgreSQL only)
+SA_ENGINE_OPTIONS = {
+    'pool_pre_ping': True,
+}
+
+# Run GET/HEAD/OPTIONS requests on an autocommit SA session
+SA_READONLY_SAFE_METHODS = True
+
+# Seconds between full reloads of the in-process country/eye color
+# snapshots; on PostgreSQL writes are also picked up through LISTEN/NOTIFY
+CATALOGUE_REFRESH_INTERVAL = 60
+
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/2.1/howto/static-files/
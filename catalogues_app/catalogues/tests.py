@@ -0,0 +1,97 @@
+import os
+from collections import namedtuple
+from uuid import uuid4
+
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+from rest_framework.test import APIClient
+from sa_helper import Session
+
+from .mappings import Country
+from .registry import ReferenceRegistry, Snapshot, registry
+
+Row = namedtuple('Row', ('id', 'name', 'description'))
+
+
+class SnapshotTestCase(SimpleTestCase):
+
+    def testContentToken(self):
+        rows = [Row(uuid4(), 'first', ''), Row(uuid4(), 'second', '')]
+        snapshot = Snapshot(rows)
+        self.assertIs(snapshot.by_id[str(rows[1].id)], rows[1])
+        # Same content loaded by another process or refresh, same token
+        self.assertEqual(Snapshot(list(rows)).token, snapshot.token)
+        changed = [rows[0], rows[1]._replace(name='renamed')]
+        self.assertNotEqual(Snapshot(changed).token, snapshot.token)
+        self.assertNotEqual(Snapshot(rows[:1]).token, snapshot.token)
+
+
+@override_settings(SA_DATABASE_URL='sqlite:///test.db')
+class ReferenceRegistryTestCase(SimpleTestCase):
+
+    def setUp(self):
+        from sa_helper.management.commands.create_schema import Command
+        try:
+            os.remove(os.path.join(settings.BASE_DIR, 'test.db'))
+        except FileNotFoundError:
+            pass
+        Command().handle()
+
+    def tearDown(self):
+        Session().close_all()
+        os.remove(os.path.join(settings.BASE_DIR, 'test.db'))
+
+    def testRefresh(self):
+        registry = ReferenceRegistry()
+        registry.register(Country)
+        sa_session = Session()
+        sa_session.add(Country(id=uuid4(), name='first', description=''))
+        sa_session.commit()
+
+        first = registry.refresh(Country.__tablename__)
+        self.assertEqual([row.name for row in first.rows], ['first'])
+        # Unchanged rows keep the snapshot and its rendered representations
+        self.assertIs(registry.refresh(Country.__tablename__), first)
+
+        sa_session.add(Country(id=uuid4(), name='second', description=''))
+        sa_session.commit()
+        second = registry.refresh(Country.__tablename__)
+        self.assertNotEqual(second.token, first.token)
+        self.assertEqual([row.id for row in second.rows], sorted(row.id for row in second.rows))
+        self.assertEqual({row.name for row in second.rows}, {'first', 'second'})
+
+    def testSnapshotReads(self):
+        # The module registry outlives the test database, drop its old snapshots
+        registry.refresh_all()
+        client = APIClient()
+        ids = []
+        for name in ('first', 'second'):
+            result = client.post('/api-v1/countries/', {'name': name, 'description': ''})
+            self.assertEqual(result.status_code, 201)
+            ids.append(result.data['id'])
+
+        result = client.get('/api-v1/countries/')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual({item['name'] for item in result.data}, {'first', 'second'})
+        etag = result['ETag']
+        result = client.get('/api-v1/countries/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(result.status_code, 304)
+        result = client.get('/api-v1/countries/{}/'.format(ids[0]))
+        self.assertEqual(result.data['name'], 'first')
+
+        # Requested order, unknown ids skipped
+        expected = ['second', 'first']
+        result = client.get('/api-v1/countries/', {'ids': ','.join([ids[1], str(uuid4()), ids[0]])})
+        self.assertEqual([item['name'] for item in result.data], expected)
+        result = client.post('/api-v1/countries/lookup/', {'ids': [ids[1], str(uuid4()), ids[0]]}, format='json')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual([item['name'] for item in result.data], expected)
+        result = client.post('/api-v1/countries/lookup/', {}, format='json')
+        self.assertEqual(result.status_code, 400)
+
+        # A write refreshes the snapshot, so the old ETag no longer matches
+        result = client.patch('/api-v1/countries/{}/'.format(ids[0]), {'name': 'renamed'}, format='json')
+        self.assertEqual(result.status_code, 200)
+        result = client.get('/api-v1/countries/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual({item['name'] for item in result.data}, {'renamed', 'second'})
@@ -1,10 +1,17 @@
-from django.utils.decorators import method_decorator
-from django.views.decorators.cache import cache_page
+from uuid import UUID
 
+from django.utils.cache import get_conditional_response
 from rest_framework import serializers, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, ParseError
+from rest_framework.response import Response
 
 from sa_helper.viewsets import SerializerModelMixin, ViewSetModelMixin
 from .mappings import Country, EyeColor
+from .registry import registry
+
+registry.register(Country)
+registry.register(EyeColor)
 
 
 class BaseSerializer(SerializerModelMixin, serializers.Serializer):
@@ -30,19 +37,76 @@ class EyeColorSerializer(BaseSerializer):
                                                lookup_url_kwarg='pk')
 
 
-class CountryViewSet(ViewSetModelMixin, viewsets.ViewSet):
+class SnapshotReadMixin:
+    """
+    Serves unpaginated lists, ?ids= lookups and retrieves from the
+    in-process snapshot of the table (see registry), writes refresh it in
+    every process.
+    POST lookup/ with {"ids": [...]}: the ?ids= lookup for long id lists.
+    """
+
+    def _snapshot_response(self, request, snapshot, data):
+        etag = snapshot.etag(request)
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            not_modified['ETag'] = etag
+            return not_modified
+        response = Response(data)
+        response['ETag'] = etag
+        return response
+
+    def _lookup(self, request, ids):
+        """
+        Returns the snapshot and representations of ids in their order, skipping missing ones
+        """
+        snapshot = registry.snapshot(self.serializer_class.model)
+        items, by_id = snapshot.rendered(self.serializer_class, request)
+        keys = [str(pk) for pk in ids]
+        return snapshot, [by_id[key] for key in keys if key in by_id]
+
+    def list(self, request, **kwargs):
+        ids = self.get_lookup_ids(request)
+        if ids is not None:
+            return self._snapshot_response(request, *self._lookup(request, ids))
+        if self.is_streaming_requested(request) or self.get_paginator(request) is not None:
+            return super().list(request, **kwargs)
+        snapshot = registry.snapshot(self.serializer_class.model)
+        items, by_id = snapshot.rendered(self.serializer_class, request)
+        return self._snapshot_response(request, snapshot, list(items))
+
+    @action(detail=False, methods=['post'])
+    def lookup(self, request, **kwargs):
+        ids = request.data.get('ids') if hasattr(request.data, 'get') else None
+        if ids is None:
+            raise ParseError('ids is required')
+        snapshot, data = self._lookup(request, self.parse_lookup_ids(ids))
+        return Response(data)
+
+    def retrieve(self, request, pk=None, **kwargs):
+        try:
+            key = str(UUID(pk))
+        except ValueError:
+            raise ParseError
+        snapshot = registry.snapshot(self.serializer_class.model)
+        items, by_id = snapshot.rendered(self.serializer_class, request)
+        if key not in by_id:
+            raise NotFound
+        return self._snapshot_response(request, snapshot, by_id[key])
+
+    def post_save(self, request):
+        registry.changed(self.serializer_class.model)
+
+    def post_destroy(self, request):
+        registry.changed(self.serializer_class.model)
+
+
+class CountryViewSet(SnapshotReadMixin, ViewSetModelMixin, viewsets.ViewSet):
     serializer_class = CountrySerializer
-
-    @method_decorator(cache_page(60 * 60 * 24, key_prefix='countries'))
-    def dispatch(self, request, *args, **kwargs):
-        return super().dispatch(request, *args, **kwargs)
+    read_cache_timeout = 60 * 60 * 24
 
 
-class EyeColorViewSet(ViewSetModelMixin, viewsets.ViewSet):
+class EyeColorViewSet(SnapshotReadMixin, ViewSetModelMixin, viewsets.ViewSet):
     serializer_class = EyeColorSerializer
-
-    @method_decorator(cache_page(60 * 60 * 24, key_prefix='eye_colors'))
-    def dispatch(self, request, *args, **kwargs):
-        return super().dispatch(request, *args, **kwargs)
+    read_cache_timeout = 60 * 60 * 24
 
 
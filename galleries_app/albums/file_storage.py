@@ -1,8 +1,20 @@
+from contextlib import contextmanager
+
+from django.conf import settings
 from django.core.files.storage import FileSystemStorage
 
+import fcntl
+import hashlib
+import re
 import uuid
 import os.path
 
+# Lock files content-addressed filenames are spread over
+LOCK_STRIPES = 256
+# Names generate_uuid4_filename and content_addressed_filename produce
+ORIGINAL_FILENAME = re.compile(
+    r'^(?:[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|[0-9a-f]{64})(?:\.[^./]+)?$')
+
 def generate_uuid4_filename(filename):
     """
     Generates a uuid4 (random) filename, keeping file extension
@@ -16,8 +28,64 @@ def generate_uuid4_filename(filename):
     basename = str(uuid.uuid4())
     return ''.join((basename, ext))
 
+def content_addressed_filename(sha256, filename):
+    """
+    Generates a filename from the content hash, keeping file extension
+
+    :param sha256: Hex digest of the file content
+    :param filename: Filename passed in, used for its extension only
+    :return: Filename identical for identical uploads
+    :rtype: str
+    """
+    discard, ext = os.path.splitext(filename)
+    return ''.join((sha256, ext.lower()))
+
+def is_original_filename(filename):
+    """
+    Tells stored originals from thumbnails and other MEDIA_ROOT files
+    """
+    return ORIGINAL_FILENAME.match(filename) is not None
+
+def is_content_addressed():
+    return getattr(settings, 'PHOTO_CONTENT_ADDRESSED_STORAGE', False)
+
+@contextmanager
+def stored_file_lock(filename):
+    """
+    Serializes storing a content-addressed file with deleting it once
+    unreferenced, across processes sharing MEDIA_ROOT
+    """
+    directory = os.path.join(settings.MEDIA_ROOT, '.locks')
+    os.makedirs(directory, exist_ok=True)
+    stripe = int(hashlib.md5(filename.encode('utf-8')).hexdigest(), 16) % LOCK_STRIPES
+    with open(os.path.join(directory, '{:02x}.lock'.format(stripe)), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+def file_sha256(file):
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
 def save_uploaded_photo(file):
+    stored_name = getattr(file, 'stored_name', None)
+    if stored_name is not None:
+        # Already streamed into MEDIA_ROOT by MediaStreamingUploadHandler
+        return stored_name
+    storage = FileSystemStorage()
+    if is_content_addressed():
+        filename = content_addressed_filename(file_sha256(file), file.name)
+        with stored_file_lock(filename):
+            if storage.exists(filename):
+                return filename
+            return storage.save(filename, file)
+    else:
+        filename = generate_uuid4_filename(file.name)
+    return storage.save(filename, file)
+
+def delete_photo_files(filenames):
     storage = FileSystemStorage()
-    filename = generate_uuid4_filename(file.name)
-    storage.save(filename, file)
-    return filename
+    for filename in filenames:
+        storage.delete(filename)
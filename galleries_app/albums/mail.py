@@ -0,0 +1,97 @@
+"""
+Upload notification delivery over one mail connection per worker process.
+
+The connection is opened on first use and kept open across tasks. It's
+re-opened when idle for longer than EMAIL_CONNECTION_MAX_IDLE seconds,
+which SMTP servers commonly time out, and once more when a send fails
+because the server dropped it.
+"""
+
+import os
+import smtplib
+import socket
+import threading
+import time
+
+from django.conf import settings
+from django.core.mail import get_connection
+
+# Errors after which a message wasn't accepted and a new connection may deliver it
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, socket.timeout)
+
+
+class MailConnection:
+
+    def __init__(self, backend=None, **kwargs):
+        """
+        :param backend, kwargs: get_connection() arguments, EMAIL_BACKEND by default
+        """
+        self.backend = backend
+        self.kwargs = kwargs
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+        self._last_used = 0.0
+
+    @property
+    def max_idle(self):
+        return getattr(settings, 'EMAIL_CONNECTION_MAX_IDLE', 60)
+
+    def _get(self):
+        if self._connection is not None and self._pid != os.getpid():
+            # Inherited through fork(), the socket is the parent's
+            self._connection = None
+        if (self._connection is not None
+                and time.monotonic() - self._last_used > self.max_idle):
+            self._close()
+        if self._connection is None:
+            connection = get_connection(self.backend, fail_silently=False, **self.kwargs)
+            connection.open()
+            self._connection, self._pid = connection, os.getpid()
+        return self._connection
+
+    def _close(self):
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            try:
+                connection.close()
+            except CONNECTION_ERRORS:
+                pass
+
+    def send_messages(self, messages):
+        """
+        Sends EmailMessages over the shared connection, returns the number sent
+        """
+        with self._lock:
+            for attempt in range(2):
+                connection = self._get()
+                try:
+                    sent = connection.send_messages(messages)
+                except CONNECTION_ERRORS:
+                    self._close()
+                    if attempt:
+                        raise
+                    continue
+                self._last_used = time.monotonic()
+                return sent
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._close()
+
+
+mail_connection = MailConnection()
+
+
+def _close_on_shutdown(**kwargs):
+    mail_connection.close()
+
+
+def connect_mail_signals():
+    """
+    Closes the shared connection when a worker process stops
+    """
+    from celery import signals
+    signals.worker_process_shutdown.connect(_close_on_shutdown, weak=False)
+    signals.worker_shutdown.connect(_close_on_shutdown, weak=False)
@@ -0,0 +1,174 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from uuid import UUID
+
+from django.core.management.base import BaseCommand, CommandError
+
+# _backfill results of photos which can't be rendered
+MISSING = 'missing'
+UNREADABLE = 'unreadable'
+
+
+def _load_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        raise CommandError('Unreadable checkpoint {}, pass --restart to start over'.format(path))
+
+
+def _save_checkpoint(path, state):
+    partial = path + '.part'
+    with open(partial, 'w') as f:
+        json.dump(state, f)
+    os.replace(partial, path)
+
+
+def _plan(filename, thumbnails, force):
+    """
+    Returns (sizes to render, thumbnails map to store)
+    """
+    from django.conf import settings
+    from albums.thumbnails import stale_sizes, thumbnails_map
+    expected = thumbnails_map(filename, settings.THUMBNAIL_SIZES)
+    if force:
+        return list(settings.THUMBNAIL_SIZES), expected
+    return stale_sizes(filename, thumbnails), expected
+
+
+def _backfill(filename, thumbnails, force, dry_run):
+    """
+    Returns (rendered size names, thumbnails map to store), MISSING or
+    UNREADABLE for originals which can't be rendered
+    """
+    from django.conf import settings
+    from PIL import Image
+    from albums.thumbnails import write_thumbnails
+    try:
+        size_names, expected = _plan(filename, thumbnails, force)
+        if size_names and not dry_run:
+            write_thumbnails(filename, {name: settings.THUMBNAIL_SIZES[name] for name in size_names})
+    except FileNotFoundError:
+        return MISSING
+    except (OSError, SyntaxError, Image.DecompressionBombError):
+        # A corrupt original mustn't stop the run on every resume
+        return UNREADABLE
+    return size_names, expected
+
+
+class Command(BaseCommand):
+    help = ('Renders missing or stale thumbnails of stored photos after THUMBNAIL_SIZES '
+            'or THUMBNAIL_ENCODINGS changes and updates their thumbnails column. '
+            'Every configured size is rendered, THUMBNAIL_LAZY included. Only sizes, '
+            'formats and names are checked, pass --force after changing an '
+            'encoding\'s quality or other save options.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Photo rows read, rendered and updated at a time')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Rendering threads, THUMBNAIL_RENDER_CONCURRENCY by default')
+        parser.add_argument('--checkpoint', default=None,
+                            help='File recording the last finished batch; an existing '
+                                 'one resumes the run after it')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore an existing checkpoint')
+        parser.add_argument('--force', action='store_true',
+                            help='Re-render every size of every photo')
+        parser.add_argument('--delete-stale', action='store_true',
+                            help='Delete thumbnail files no longer in a photo\'s thumbnails')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report photos which would be re-rendered')
+
+    def handle(self, *args, **options):
+        from django.conf import settings
+        from sa_helper import Session
+        from albums.file_storage import delete_photo_files
+        from albums.mappings import Photo
+        from albums.thumbnail_store import write_thumbnail_paths
+        from albums.thumbnails import thumbnail_files
+
+        batch_size = options['batch_size']
+        workers = options['workers'] or getattr(settings, 'THUMBNAIL_RENDER_CONCURRENCY', 1)
+        if batch_size < 1 or workers < 1:
+            raise CommandError('--batch-size and --workers must be positive')
+        checkpoint = options['checkpoint']
+        state = {}
+        if checkpoint and not options['restart']:
+            state = _load_checkpoint(checkpoint)
+        last_id = UUID(state['last_id']) if state.get('last_id') else None
+        totals = {name: state.get(name, 0)
+                  for name in ('photos', 'updated', 'rendered', MISSING, UNREADABLE)}
+        if last_id is not None:
+            self.stdout.write('Resuming after {} ({} photos done)'.format(last_id, totals['photos']))
+
+        sa_session = Session()
+        started = time.monotonic()
+        run_photos = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                query = sa_session.query(Photo.id, Photo.orig_file, Photo.thumbnails)
+                if last_id is not None:
+                    query = query.filter(Photo.id > last_id)
+                rows = query.order_by(Photo.id).limit(batch_size).all()
+                sa_session.commit()
+                if not rows:
+                    break
+
+                # Photos sharing a content-addressed file are rendered once
+                pending = {}
+                for row in rows:
+                    if row.thumbnails and 'status' in row.thumbnails:
+                        # Upload still being processed, its task stores the thumbnails
+                        continue
+                    pending.setdefault(row.orig_file, row.thumbnails)
+                results = dict(zip(pending, executor.map(
+                    lambda item: _backfill(item[0], item[1], options['force'], options['dry_run']),
+                    pending.items())))
+
+                entries = []
+                stale_files = set()
+                for row in rows:
+                    if row.orig_file not in results:
+                        continue
+                    result = results[row.orig_file]
+                    if result in (MISSING, UNREADABLE):
+                        totals[result] += 1
+                        continue
+                    size_names, expected = result
+                    if row.thumbnails == expected and not size_names:
+                        continue
+                    entries.append((row.id, row.orig_file, expected))
+                    if row.thumbnails:
+                        stale_files.update(set(thumbnail_files(row.thumbnails))
+                                           - set(thumbnail_files(expected)))
+                totals['rendered'] += sum(len(result[0]) for result in results.values()
+                                          if result not in (MISSING, UNREADABLE))
+                totals['updated'] += len(entries)
+
+                if entries and not options['dry_run']:
+                    # Rows whose file was replaced meanwhile keep their new thumbnails
+                    write_thumbnail_paths(entries)
+                    if options['delete_stale'] and stale_files:
+                        delete_photo_files(stale_files)
+
+                last_id = rows[-1].id
+                totals['photos'] += len(rows)
+                run_photos += len(rows)
+                if checkpoint and not options['dry_run']:
+                    _save_checkpoint(checkpoint, dict(totals, last_id=str(last_id)))
+                elapsed = time.monotonic() - started
+                self.stdout.write('{photos} photos, {updated} updated, {rendered} sizes rendered, '
+                                  '{missing} originals missing, {unreadable} unreadable; '
+                                  '{rate:.1f} photos/s'.format(
+                                      rate=run_photos / elapsed if elapsed else 0.0, **totals))
+        Session.remove()
+
+        elapsed = time.monotonic() - started
+        self.stdout.write('Done in {:.1f} s: {} photos ({:.1f}/s), {} rows {}updated'.format(
+            elapsed, run_photos, run_photos / elapsed if elapsed else 0.0, totals['updated'],
+            'would be ' if options['dry_run'] else ''))
@@ -0,0 +1,81 @@
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+
+from django.core.management.base import BaseCommand
+
+
+def legacy_thumbnails(path, sizes):
+    """
+    Pre single-decode pipeline: re-opens and decodes the original per size
+    """
+    from PIL import Image
+    from albums.thumbnails import thumbnail_filename
+    for size_name, size in sizes.items():
+        im = Image.open(path)
+        im.thumbnail(size)
+        im.save(thumbnail_filename(path, size_name))
+
+
+def single_decode_thumbnails(path, sizes):
+    from albums.thumbnails import render_thumbnails, thumbnail_filename
+    for size_name, im in render_thumbnails(path, sizes):
+        im.save(thumbnail_filename(path, size_name))
+
+
+def _peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def _run(args):
+    func, path, sizes = args
+    started = time.perf_counter()
+    func(path, sizes)
+    return time.perf_counter() - started, _peak_rss_kb()
+
+
+def make_jpeg(directory, megapixels):
+    from PIL import Image, ImageDraw
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    image = Image.new('RGB', (width, height), (40, 90, 160))
+    draw = ImageDraw.Draw(image)
+    for i in range(0, width, 97):
+        draw.line((i, 0, width - i, height), fill=(i % 255, 200, 80), width=9)
+    path = os.path.join(directory, '{}mp.jpg'.format(megapixels))
+    image.save(path, quality=90)
+    return path
+
+
+class Command(BaseCommand):
+    help = 'Times thumbnail rendering per upload and reports peak RSS, legacy vs single-decode'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--megapixels', type=int, nargs='+', default=[12, 24, 50])
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        from django.conf import settings
+        sizes = settings.THUMBNAIL_SIZES
+        directory = tempfile.mkdtemp()
+        try:
+            for megapixels in options['megapixels']:
+                path = make_jpeg(directory, megapixels)
+                for name, func in (('legacy', legacy_thumbnails),
+                                   ('single-decode', single_decode_thumbnails)):
+                    # A fresh process per run, so ru_maxrss is this upload's peak
+                    with Pool(1, maxtasksperchild=1) as pool:
+                        runs = [pool.apply(_run, ((func, path, sizes),))
+                                for _ in range(options['repeat'])]
+                    best = min(seconds for seconds, rss in runs)
+                    peak = max(rss for seconds, rss in runs)
+                    self.stdout.write('{:>3} MP {:<14} {:>8.0f} ms {:>8.1f} MB peak RSS'.format(
+                        megapixels, name, best * 1000, peak / 1024))
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,77 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+SMTP_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+LOCMEM_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+
+
+def _start_smtp_sink():
+    """
+    Starts a local SMTP server discarding messages, returns (server, port)
+    """
+    import asyncore
+    import smtpd
+
+    class Sink(smtpd.SMTPServer):
+        def process_message(self, *args, **kwargs):
+            return None
+
+    server = Sink(('127.0.0.1', 0), None, decode_data=False)
+    thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.05}, daemon=True)
+    thread.start()
+    return server, server.socket.getsockname()[1]
+
+
+class Command(BaseCommand):
+    help = ('Reports upload notification messages/sec, a connection per message '
+            'vs the shared worker connection')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=500)
+        parser.add_argument('--smtp', action='store_true',
+                            help='Deliver to a local SMTP sink instead of the locmem backend')
+
+    def handle(self, *args, **options):
+        from django.core import mail
+        from django.core.mail import EmailMessage, get_connection
+        from albums.mail import MailConnection
+
+        server = None
+        backend, kwargs = LOCMEM_BACKEND, {}
+        if options['smtp']:
+            server, port = _start_smtp_sink()
+            backend, kwargs = SMTP_BACKEND, {'host': '127.0.0.1', 'port': port,
+                                             'use_tls': False, 'use_ssl': False,
+                                             'username': '', 'password': ''}
+        count = options['messages']
+
+        def message(i):
+            return EmailMessage('New photo uploaded', 'Photo {}'.format(i),
+                                'uploads@mysite.com', ['user@mysite.com'])
+
+        def per_message():
+            # What send_mail() does: a new connection for every message
+            for i in range(count):
+                get_connection(backend, fail_silently=False, **kwargs).send_messages([message(i)])
+
+        shared = MailConnection(backend, **kwargs)
+
+        def pooled():
+            for i in range(count):
+                shared.send_messages([message(i)])
+
+        try:
+            for name, func in (('connection per message', per_message),
+                               ('shared connection', pooled)):
+                mail.outbox = []
+                started = time.monotonic()
+                func()
+                elapsed = time.monotonic() - started
+                self.stdout.write('{:<24} {:>6} messages {:>10.1f} messages/s'.format(
+                    name, count, count / elapsed if elapsed else 0.0))
+        finally:
+            shared.close()
+            if server is not None:
+                server.close()
@@ -1,21 +1,49 @@
-from sqlalchemy import Column, String, ForeignKey
+from datetime import datetime
+from uuid import uuid4
+
+from sqlalchemy import Column, DateTime, String, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy_utils import UUIDType, JSONType
-from sa_helper import BaseMapping
+from sa_helper import BaseMapping, Versioned
 
-class Album(BaseMapping):
+class Album(Versioned, BaseMapping):
     __tablename__ = 'album'
+    __table_args__ = (
+        # Owner's albums in keyset pagination order
+        Index('ix_album_user_id_id', 'user_id', 'id'),
+    )
 
     id = Column(UUIDType, primary_key=True)
     user_id = Column(UUIDType, ForeignKey('user.id'), nullable=False)
     name = Column(String(length=200))
     description = Column(String(length=300), default='')
 
-class Photo(BaseMapping):
+class Photo(Versioned, BaseMapping):
     __tablename__ = 'photo'
+    __table_args__ = (
+        # Album's photos in keyset pagination order
+        Index('ix_photo_album_id_id', 'album_id', 'id'),
+        # Reference lookups of content-addressed files
+        Index('ix_photo_orig_file', 'orig_file'),
+    )
 
     id = Column(UUIDType, primary_key=True)
     album_id = Column(UUIDType, ForeignKey('album.id', ondelete='CASCADE'), nullable=False)
     orig_file = Column(String(length=300), nullable=False)
     thumbnails = Column(JSONType)
-    album = relationship('Album')
\ No newline at end of file
+    album = relationship('Album')
+
+
+class UploadNotification(BaseMapping):
+    """
+    Upload waiting to be listed in its owner's digest email
+    """
+    __tablename__ = 'upload_notification'
+    __table_args__ = (
+        Index('ix_upload_notification_user_id', 'user_id'),
+    )
+
+    id = Column(UUIDType, primary_key=True, default=uuid4)
+    user_id = Column(UUIDType, ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    thumbnails = Column(JSONType, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
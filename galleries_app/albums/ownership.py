@@ -0,0 +1,51 @@
+from uuid import UUID
+
+from sa_helper import Session
+
+from .mappings import Album
+
+
+class AlbumOwnership:
+    """
+    Per request cache of "does request.user own this album" answers.
+
+    Permission checks, object lookups and validated data of one request
+    share a single ownership query per album.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self._albums = {}
+
+    @classmethod
+    def of(cls, request):
+        ownership = getattr(request, '_album_ownership', None)
+        if ownership is None:
+            ownership = cls(request)
+            request._album_ownership = ownership
+        return ownership
+
+    def is_resolved(self, album_id):
+        return album_id in self._albums
+
+    def owned_album_id(self, album_id):
+        """
+        Returns the album's UUID if the user owns it, None otherwise
+        """
+        if album_id not in self._albums:
+            self._albums[album_id] = self._resolve(album_id)
+        return self._albums[album_id]
+
+    def _resolve(self, album_id):
+        user_id = getattr(self.request.user, 'id', None)
+        if user_id is None:
+            return None
+        try:
+            album_uuid = UUID(album_id)
+        except ValueError:
+            return None
+        owned = Session().query(Album.id).filter(
+            Album.id == album_uuid,
+            Album.user_id == user_id
+        ).first()
+        return album_uuid if owned is not None else None
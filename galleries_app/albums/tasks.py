@@ -1,66 +1,184 @@
-import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from uuid import UUID
 
 from django.conf import settings
-from django.core.mail import send_mail
+from django.core.cache import cache
+from django.core.mail import EmailMessage
+from django.urls import reverse
 
 from celery import shared_task
-from PIL import Image
 
 from sa_helper import Session
 from users.mappings import User
-from .mappings import Photo
+from .mail import connect_mail_signals, mail_connection
+from .mappings import UploadNotification
+from .thumbnail_store import connect_worker_signals, thumbnail_path_buffer, write_thumbnail_paths
+from .thumbnails import VARIANTS_KEY, lazy_sizes, thumbnails_map, write_thumbnails
 
+connect_worker_signals()
+connect_mail_signals()
 
+DIGEST_SCHEDULED_KEY = 'albums:upload-digest:{}'
+
+
+
+def _create_thumbnails(filename, image_info=None):
+    # With THUMBNAIL_LAZY every size is rendered on first request instead
+    sizes = {} if getattr(settings, 'THUMBNAIL_LAZY', False) else settings.THUMBNAIL_SIZES
+    write_thumbnails(filename, sizes, image_info)
+    return thumbnails_map(filename, sizes)
 
 @shared_task()
-def create_thumbnails(filename):
-    sizes = settings.THUMBNAIL_SIZES
-    basename, ext = os.path.splitext(filename)
-    result = {}
-    for size_name, size in sizes.items():
-        new_filename = '{}.{}{}'.format(basename, size_name, ext)
-        im = Image.open(os.path.join(settings.MEDIA_ROOT, filename))
-        im.thumbnail(size)
-        im.save(os.path.join(settings.MEDIA_ROOT, new_filename))
-        result[size_name] = new_filename
-    result['fullsize'] = filename
-    return result
+def create_thumbnails(filename, image_info=None):
+    return _create_thumbnails(filename, image_info)
 
 @shared_task()
-def store_thumbnail_paths(filenames, photo_id):
-    sa_session = Session()
-    photo = sa_session.query(Photo).filter(Photo.id == UUID(photo_id)).one()
-    photo.thumbnails = filenames
-    sa_session.commit()
+def create_thumbnails_batch(filenames, image_infos=None):
+    """
+    Renders thumbnails of several uploads on THUMBNAIL_RENDER_CONCURRENCY
+    threads. Pillow releases the GIL while decoding and resampling, so the
+    uploads use several cores of one worker process; a prefork worker's
+    children can't start process pools of their own. Each upload is
+    rendered exactly as create_thumbnails does.
+    """
+    image_infos = image_infos or [None] * len(filenames)
+    concurrency = min(getattr(settings, 'THUMBNAIL_RENDER_CONCURRENCY', 1), len(filenames))
+    if concurrency <= 1:
+        return [_create_thumbnails(filename, image_info)
+                for filename, image_info in zip(filenames, image_infos)]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(_create_thumbnails, filenames, image_infos))
+
+@shared_task(bind=True)
+def store_thumbnail_paths(self, filenames, photo_id):
+    """
+    Stores an upload's thumbnails, coalesced with other uploads' into one
+    UPDATE when THUMBNAIL_STORE_BATCH_SIZE is above 1
+    """
+    if getattr(settings, 'THUMBNAIL_STORE_BATCH_SIZE', 0) > 1 and not self.request.is_eager:
+        thumbnail_path_buffer.add(photo_id, filenames['fullsize'], filenames)
+    else:
+        write_thumbnail_paths([(photo_id, filenames['fullsize'], filenames)])
     return filenames
 
 @shared_task()
-def send_email(filenames, user_id):
-    sa_session = Session()
-    user = sa_session.query(User).filter(User.id == UUID(user_id)).one()
-    message = '''
-Dear {first_name} {last_name}
-Your photo is successfully uploaded!
-Please use these urls:
-\n'''.format(first_name=user.name, last_name=user.last_name)
-    urls = ('{name}: {site_url}{media_url}{filename}'
+def store_thumbnail_paths_batch(results, photo_ids, filenames=None):
+    """
+    Stores thumbnails of photo_ids. With filenames, the photos' files in
+    order, results are per distinct file and shared by its photos.
+    """
+    if filenames is not None:
+        by_file = {thumbnails['fullsize']: thumbnails for thumbnails in results}
+        results = [by_file[filename] for filename in filenames]
+    write_thumbnail_paths([(photo_id, thumbnails['fullsize'], thumbnails)
+                           for thumbnails, photo_id in zip(results, photo_ids)])
+    return results
+
+def _photo_urls(filenames):
+    urls = ['{name}: {site_url}{media_url}{filename}'
                 .format(name=size_name,
                         site_url=settings.SITE_URL_IN_EMAIL,
                         media_url=settings.MEDIA_URL,
                         filename=filename)
-            for size_name, filename in filenames.items())
-    message+='\n'.join(urls)
-    send_mail(
-        'New photo uploaded',
-        message,
-        settings.NEW_PHOTO_FROM_EMAIL,
-        [user.email],
-        fail_silently=False,
-    )
-
-def process_upload(photo_id, user_id, filename):
-    chain = (create_thumbnails.s(filename)
+            for size_name, filename in filenames.items() if size_name != VARIANTS_KEY]
+    urls.extend('{name}: {site_url}{path}'
+                    .format(name=size_name,
+                            site_url=settings.SITE_URL_IN_EMAIL,
+                            path=reverse('thumbnail', kwargs={'size_name': size_name,
+                                                              'filename': filenames['fullsize']}))
+                for size_name in lazy_sizes(filenames))
+    return '\n'.join(urls)
+
+def _recipient(user_id):
+    return (Session().query(User.name, User.last_name, User.email)
+                     .filter(User.id == UUID(user_id)).one())
+
+def _upload_message(user, results):
+    if len(results) == 1:
+        subject = 'New photo uploaded'
+        message = '''
+Dear {first_name} {last_name}
+Your photo is successfully uploaded!
+Please use these urls:
+\n'''.format(first_name=user.name, last_name=user.last_name)
+    else:
+        subject = 'New photos uploaded'
+        message = '''
+Dear {first_name} {last_name}
+Your {count} photos are successfully uploaded!
+Please use these urls:
+\n'''.format(first_name=user.name, last_name=user.last_name, count=len(results))
+    message+='\n\n'.join(_photo_urls(filenames) for filenames in results)
+    return EmailMessage(subject, message, settings.NEW_PHOTO_FROM_EMAIL, [user.email])
+
+def _notify(user_id, results):
+    window = getattr(settings, 'UPLOAD_EMAIL_DIGEST_WINDOW', 0)
+    if not window:
+        mail_connection.send_messages([_upload_message(_recipient(user_id), results)])
+        return
+    sa_session = Session()
+    sa_session.add_all([UploadNotification(user_id=UUID(user_id), thumbnails=filenames)
+                        for filenames in results])
+    sa_session.commit()
+    # The first upload of a window schedules the user's digest
+    if cache.add(DIGEST_SCHEDULED_KEY.format(user_id), True, window):
+        send_digest_email.apply_async((user_id,), countdown=window)
+
+@shared_task()
+def send_email(filenames, user_id):
+    _notify(user_id, [filenames])
+
+@shared_task()
+def send_batch_email(results, user_id, reused_results=()):
+    _notify(user_id, list(results) + list(reused_results))
+
+@shared_task()
+def send_digest_email(user_id):
+    """
+    Sends one email listing the user's uploads queued in digest mode
+    """
+    # Uploads from now on schedule the next digest
+    cache.delete(DIGEST_SCHEDULED_KEY.format(user_id))
+    sa_session = Session()
+    notifications = (sa_session.query(UploadNotification.id, UploadNotification.thumbnails)
+                               .filter(UploadNotification.user_id == UUID(user_id))
+                               .order_by(UploadNotification.created_at)
+                               .with_for_update()
+                               .all())
+    if not notifications:
+        sa_session.commit()
+        return
+    (sa_session.query(UploadNotification)
+               .filter(UploadNotification.id.in_([n.id for n in notifications]))
+               .delete(synchronize_session=False))
+    message = _upload_message(_recipient(user_id), [n.thumbnails for n in notifications])
+    mail_connection.send_messages([message])
+    sa_session.commit()
+
+def process_upload(photo_id, user_id, filename, image_info=None):
+    """
+    image_info is the upload's header data parsed while streaming (see
+    upload_handlers), None to read it from the stored file
+    """
+    chain = (create_thumbnails.s(filename, image_info)
              | store_thumbnail_paths.s(photo_id)
              | send_email.s(user_id))
     chain.apply_async()
+
+def process_upload_batch(photo_ids, user_id, filenames, reused_results=(), image_infos=None):
+    """
+    One thumbnail job, one bulk store and one summary email for a batch of
+    uploads. reused_results are thumbnails of deduplicated uploads in the
+    batch, listed in the same email. image_infos are the uploads' header
+    data as in process_upload. Photos sharing a content-addressed file are
+    rendered once, never concurrently into the same thumbnail paths.
+    """
+    image_infos = image_infos or [None] * len(filenames)
+    distinct = OrderedDict()
+    for filename, image_info in zip(filenames, image_infos):
+        distinct.setdefault(filename, image_info)
+    chain = (create_thumbnails_batch.s(list(distinct), list(distinct.values()))
+             | store_thumbnail_paths_batch.s(photo_ids, list(filenames))
+             | send_batch_email.s(user_id, list(reused_results)))
+    chain.apply_async()
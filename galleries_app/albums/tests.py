@@ -1,11 +1,20 @@
 import os
 import io
+import base64
+import shutil
+import smtplib
+import tempfile
+import uuid
 from PIL import Image
 from django.core import mail
+from django.core.mail.backends import locmem
 from django.conf import settings
 from django.test import SimpleTestCase, override_settings
-from rest_framework.test import APIClient
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
 from sa_helper import Session
+from sa_helper.read_serializers import compile_read_serializer
 
 def generate_image_file():
     file = io.BytesIO()
@@ -15,6 +24,20 @@ def generate_image_file():
     file.seek(0)
     return file
 
+class DroppingEmailBackend(locmem.EmailBackend):
+    """
+    Loses its first connection like an SMTP server timing it out
+    """
+    opened = 0
+
+    def open(self):
+        DroppingEmailBackend.opened += 1
+
+    def send_messages(self, messages):
+        if DroppingEmailBackend.opened == 1:
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        return super().send_messages(messages)
+
 @override_settings(SA_DATABASE_URL='sqlite:///test.db',
                    CELERY_BROKER_URL=None,
                    CELERY_TASK_ALWAYS_EAGER=True)
@@ -131,6 +154,140 @@ class AlbumTestCase(BaseTestCase):
         self.assertEquals(result.status_code, 200)
         self.assertEquals(len(result.data), 0)
 
+    def testKeysetPagination(self):
+        client = APIClient()
+        url = '/api-v1/albums/?session_key={}'.format(self.session1_key)
+        for i in range(3):
+            client.post(url, {'name': 'album{}'.format(i), 'description': ''})
+
+        result = client.get(url + '&page_size=2')
+        self.assertEquals(result.status_code, 200)
+        self.assertEquals(len(result.data['results']), 2)
+        self.assertIsNone(result.data['previous'])
+        first_page = [album['id'] for album in result.data['results']]
+
+        result = client.get(result.data['next'])
+        self.assertEquals(result.status_code, 200)
+        self.assertEquals(len(result.data['results']), 1)
+        self.assertIsNone(result.data['next'])
+        self.assertNotIn(result.data['results'][0]['id'], first_page)
+
+        result = client.get(result.data['previous'])
+        self.assertEquals(result.status_code, 200)
+        self.assertEquals([album['id'] for album in result.data['results']], first_page)
+
+        result = client.get(url + '&cursor=garbage')
+        self.assertEquals(result.status_code, 400)
+        # Well-formed JSON, but the key isn't a UUID string
+        result = client.get(url + '&cursor=' + base64.urlsafe_b64encode(b'{"k":[5],"r":0}').decode())
+        self.assertEquals(result.status_code, 400)
+
+    def testKeysetCursorDatetimeKeys(self):
+        from datetime import datetime
+        from albums.mappings import UploadNotification
+        from sa_helper.pagination import KeysetPagination
+        paginator = KeysetPagination((UploadNotification.created_at, UploadNotification.id))
+        position = (datetime(2018, 10, 1, 12, 30, 5, 123456), uuid.uuid4())
+        self.assertEqual(paginator.decode_cursor(paginator.encode_cursor(position, True)),
+                         (position, True))
+
+    def testLookupIds(self):
+        client = APIClient()
+        url = '/api-v1/albums/?session_key={}'
+        ids = []
+        for session_key in (self.session1_key, self.session1_key, self.session2_key):
+            result = client.post(url.format(session_key), {'name': 'album', 'description': ''})
+            ids.append(result.data['id'])
+
+        result = client.get(url.format(self.session1_key) + '&ids=' + ','.join(reversed(ids)))
+        self.assertEquals(result.status_code, 200)
+        # Other users' albums stay invisible
+        self.assertEquals([album['id'] for album in result.data], [ids[1], ids[0]])
+
+        result = client.get(url.format(self.session1_key) + '&ids=garbage')
+        self.assertEquals(result.status_code, 400)
+
+    def testConditionalReads(self):
+        client = APIClient()
+        url = '/api-v1/albums/?session_key={}'.format(self.session1_key)
+        result = client.post(url, {'name': 'album', 'description': ''})
+        album_url = '/api-v1/albums/{}/?session_key={}'.format(result.data['id'], self.session1_key)
+
+        result = client.get(url)
+        self.assertEquals(result.status_code, 200)
+        list_etag = result['ETag']
+        result = client.get(url, HTTP_IF_NONE_MATCH=list_etag)
+        self.assertEquals(result.status_code, 304)
+        self.assertEquals(result['ETag'], list_etag)
+
+        result = client.get(album_url)
+        self.assertEquals(result.status_code, 200)
+        album_etag = result['ETag']
+        self.assertTrue(result.has_header('Last-Modified'))
+        result = client.get(album_url, HTTP_IF_NONE_MATCH=album_etag)
+        self.assertEquals(result.status_code, 304)
+
+        # Other users' albums don't change this user's collection
+        client.post('/api-v1/albums/?session_key={}'.format(self.session2_key),
+                    {'name': 'album', 'description': ''})
+        result = client.get(url, HTTP_IF_NONE_MATCH=list_etag)
+        self.assertEquals(result.status_code, 304)
+
+        result = client.patch(album_url, {'name': 'renamed'})
+        self.assertEquals(result.status_code, 200)
+        result = client.get(url, HTTP_IF_NONE_MATCH=list_etag)
+        self.assertEquals(result.status_code, 200)
+        self.assertNotEquals(result['ETag'], list_etag)
+        result = client.get(album_url, HTTP_IF_NONE_MATCH=album_etag)
+        self.assertEquals(result.status_code, 200)
+        self.assertEquals(result.data['name'], 'renamed')
+
+    def testReadCache(self):
+        import json
+        from unittest import mock
+        from django.core.cache import cache
+        from albums.mappings import Album
+        from albums.viewsets import AlbumViewSet
+        cache.clear()
+        client = APIClient()
+        url = '/api-v1/albums/?session_key={}'.format(self.session1_key)
+        with mock.patch.object(AlbumViewSet, 'read_cache_timeout', 60), \
+                mock.patch.object(AlbumViewSet, 'conditional_reads', False):
+            result = client.post(url, {'name': 'album', 'description': ''})
+            album_url = '/api-v1/albums/{}/?session_key={}'.format(result.data['id'],
+                                                                   self.session1_key)
+            listed = client.get(url)
+            retrieved = client.get(album_url)
+
+            # Written behind the viewset's back: hits keep serving the cached bodies
+            sa_session = Session()
+            sa_session.query(Album).update({'name': 'unseen'})
+            sa_session.commit()
+            Session.remove()
+            result = client.get(url)
+            self.assertEquals(result.status_code, 200)
+            self.assertEquals(result.content, listed.content)
+            self.assertEquals(result['ETag'], listed['ETag'])
+            self.assertEquals(client.get(album_url).content, retrieved.content)
+            result = client.get(url, HTTP_IF_NONE_MATCH=listed['ETag'])
+            self.assertEquals(result.status_code, 304)
+
+            # Writes start new generations
+            client.post(url, {'name': 'second', 'description': ''})
+            result = client.get(url)
+            self.assertEquals(len(json.loads(result.content.decode('utf-8'))), 2)
+            self.assertNotEquals(result['ETag'], listed['ETag'])
+
+            client.patch(album_url, {'name': 'renamed'})
+            result = client.get(album_url)
+            self.assertEquals(json.loads(result.content.decode('utf-8'))['name'], 'renamed')
+
+            client.delete(album_url)
+            self.assertEquals(client.get(album_url).status_code, 404)
+            result = client.get(url)
+            self.assertEquals([album['name'] for album in json.loads(result.content.decode('utf-8'))],
+                              ['second'])
+
 
 class PhotoTestCase(BaseTestCase):
     user1_id = None
@@ -220,4 +377,361 @@ class PhotoTestCase(BaseTestCase):
                 self.album1_id, photo1_id, self.session1_key),
             {'orig_file': generate_image_file(), 'description': ''})
         self.assertEquals(result.status_code, 200)
-        self.assertEqual(len(mail.outbox), 3)
\ No newline at end of file
+        self.assertEqual(len(mail.outbox), 3)
+
+    def testCompiledSerializerOutput(self):
+        from albums.mappings import Album, Photo
+        from albums.viewsets import AlbumSerializer, PhotoSerializer
+        client = APIClient()
+        client.post(
+            '/api-v1/albums/{}/photos/?session_key={}'.format(
+                self.album1_id, self.session1_key),
+            {'orig_file': generate_image_file(), 'description': ''})
+
+        context = {'request': Request(APIRequestFactory().get('/?format=json'))}
+        renderer = JSONRenderer()
+        for serializer_class, model in ((AlbumSerializer, Album), (PhotoSerializer, Photo)):
+            rows = Session().query(model).all()
+            to_representation = compile_read_serializer(serializer_class, context)
+            self.assertEqual(
+                renderer.render([to_representation(row) for row in rows]),
+                renderer.render(serializer_class(rows, many=True, context=context).data))
+
+    def testBatchThumbnailsMatchSequential(self):
+        from albums.tasks import create_thumbnails, create_thumbnails_batch
+        from albums.thumbnails import thumbnail_files
+        filenames = ['batch{}.jpg'.format(i) for i in range(3)]
+        os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
+        for filename in filenames:
+            with open(os.path.join(settings.MEDIA_ROOT, filename), 'wb') as f:
+                f.write(generate_image_file().read())
+
+        def rendered(results):
+            contents = []
+            for result in results:
+                for filename in sorted(thumbnail_files(result)):
+                    with open(os.path.join(settings.MEDIA_ROOT, filename), 'rb') as f:
+                        contents.append(f.read())
+            return contents
+
+        try:
+            with self.settings(THUMBNAIL_RENDER_CONCURRENCY=3):
+                batch = create_thumbnails_batch(filenames)
+            batch_contents = rendered(batch)
+            sequential = [create_thumbnails(filename) for filename in filenames]
+            self.assertEqual(batch, sequential)
+            self.assertEqual(batch_contents, rendered(sequential))
+        finally:
+            for filename in os.listdir(settings.MEDIA_ROOT):
+                if filename.startswith('batch'):
+                    os.remove(os.path.join(settings.MEDIA_ROOT, filename))
+
+    def testBulkUpload(self):
+        client = APIClient()
+        url = '/api-v1/albums/{}/photos/bulk/?session_key={}'
+        result = client.post(url.format(self.album1_id, self.session1_key),
+                             {'orig_file': [generate_image_file() for i in range(3)]})
+        self.assertEquals(result.status_code, 201)
+        self.assertEqual(len(result.data), 3)
+        self.assertEqual(len(mail.outbox), 1)
+
+        result = client.get('/api-v1/albums/{}/photos/?session_key={}'.format(
+            self.album1_id, self.session1_key))
+        self.assertEqual(len(result.data), 3)
+        for photo in result.data:
+            self.assertIn('small', photo['thumbnails'])
+
+        result = client.post(url.format(self.album2_id, self.session1_key),
+                             {'orig_file': [generate_image_file()]})
+        self.assertEquals(result.status_code, 403)
+
+        broken_file = io.BytesIO(b'not an image')
+        broken_file.name = 'broken.jpg'
+        result = client.post(url.format(self.album1_id, self.session1_key),
+                             {'orig_file': [generate_image_file(), broken_file]})
+        self.assertEquals(result.status_code, 400)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def testUploadIntegrity(self):
+        client = APIClient()
+        url = '/api-v1/albums/{}/photos/?session_key={}'.format(self.album1_id, self.session1_key)
+        os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
+        before = set(os.listdir(settings.MEDIA_ROOT))
+
+        # The header parses, the body doesn't
+        png = io.BytesIO()
+        Image.new('RGB', size=(100, 100), color=(0, 155, 0)).save(png, 'png')
+        truncated = io.BytesIO(png.getvalue()[:len(png.getvalue()) // 2])
+        truncated.name = 'truncated.png'
+        result = client.post(url, {'orig_file': truncated})
+        self.assertEquals(result.status_code, 400)
+        self.assertEqual(set(os.listdir(settings.MEDIA_ROOT)), before)
+
+        # Only the stored one of several parts is kept
+        result = client.post(url, {'orig_file': [generate_image_file(), generate_image_file()]})
+        self.assertEquals(result.status_code, 201)
+        stored_name = os.path.basename(result.data['orig_file'])
+        added = set(os.listdir(settings.MEDIA_ROOT)) - before
+        self.assertIn(stored_name, added)
+        self.assertEqual({name.split('.')[0] for name in added}, {stored_name.split('.')[0]})
+
+    @override_settings(PHOTO_CONTENT_ADDRESSED_STORAGE=True)
+    def testContentAddressedDeduplication(self):
+        client = APIClient()
+        url = '/api-v1/albums/{}/photos/?session_key={}'.format(self.album1_id, self.session1_key)
+        result = client.post(url, {'orig_file': generate_image_file()})
+        self.assertEquals(result.status_code, 201)
+        photo1_id = result.data['id']
+        result = client.get('/api-v1/albums/{}/photos/{}/?session_key={}'.format(
+            self.album1_id, photo1_id, self.session1_key))
+        thumbnails = result.data['thumbnails']
+        self.assertIn('small', thumbnails)
+
+        result = client.post(url, {'orig_file': generate_image_file()})
+        self.assertEquals(result.status_code, 201)
+        photo2_id = result.data['id']
+        self.assertEqual(result.data['thumbnails'], thumbnails)
+        self.assertEqual(len(mail.outbox), 2)
+
+        orig_path = os.path.join(settings.MEDIA_ROOT, os.path.basename(thumbnails['fullsize']))
+        small_path = os.path.join(settings.MEDIA_ROOT, os.path.basename(thumbnails['small']))
+        detail_url = '/api-v1/albums/{}/photos/{}/?session_key={}'
+        result = client.delete(detail_url.format(self.album1_id, photo1_id, self.session1_key))
+        self.assertEquals(result.status_code, 204)
+        self.assertTrue(os.path.exists(orig_path))
+        self.assertTrue(os.path.exists(small_path))
+
+        result = client.delete(detail_url.format(self.album1_id, photo2_id, self.session1_key))
+        self.assertEquals(result.status_code, 204)
+        self.assertFalse(os.path.exists(orig_path))
+        self.assertFalse(os.path.exists(small_path))
+
+        # An upload which found the file before its last row was deleted puts it back
+        from albums.upload_handlers import StoredUploadedFile
+        spare_path = os.path.join(settings.MEDIA_ROOT, '.spare.part')
+        with open(spare_path, 'wb') as f:
+            f.write(generate_image_file().read())
+        upload = StoredUploadedFile(os.path.basename(orig_path), 'test.jpg', 'image/jpeg', 0,
+                                    None, None, sha256=None, image_info=None, created=False,
+                                    spare_path=spare_path)
+        self.assertTrue(upload.restore())
+        self.assertTrue(os.path.exists(orig_path))
+        self.assertFalse(os.path.exists(spare_path))
+        os.remove(orig_path)
+
+        # Identical files of one bulk upload are rendered once and share thumbnails
+        result = client.post('/api-v1/albums/{}/photos/bulk/?session_key={}'.format(
+                                 self.album1_id, self.session1_key),
+                             {'orig_file': [generate_image_file(), generate_image_file()]})
+        self.assertEquals(result.status_code, 201)
+        result = client.get(url)
+        self.assertEqual(len(result.data), 2)
+        self.assertEqual(result.data[0]['thumbnails'], result.data[1]['thumbnails'])
+        self.assertIn('small', result.data[0]['thumbnails'])
+
+    def testLazyThumbnails(self):
+        cache_root = tempfile.mkdtemp()
+        client = APIClient()
+        try:
+            with self.settings(THUMBNAIL_LAZY=True, THUMBNAIL_CACHE_ROOT=cache_root):
+                result = client.post(
+                    '/api-v1/albums/{}/photos/?session_key={}'.format(
+                        self.album1_id, self.session1_key),
+                    {'orig_file': generate_image_file()})
+                self.assertEquals(result.status_code, 201)
+                result = client.get('/api-v1/albums/{}/photos/?session_key={}'.format(
+                    self.album1_id, self.session1_key))
+                thumbnails = result.data[0]['thumbnails']
+                self.assertIn('/thumbnails/small/', thumbnails['small'])
+                self.assertIn('/thumbnails/middle/', thumbnails['middle'])
+                self.assertEqual(len(os.listdir(cache_root)), 0)
+
+                for i in range(2):
+                    result = client.get(thumbnails['small'])
+                    self.assertEquals(result.status_code, 200)
+                    image = Image.open(io.BytesIO(b''.join(result.streaming_content)))
+                    self.assertLessEqual(image.size[0], settings.THUMBNAIL_SIZES['small'][0])
+
+                filename = os.path.basename(thumbnails['fullsize'])
+                result = client.get('/thumbnails/huge/{}'.format(filename))
+                self.assertEquals(result.status_code, 404)
+                result = client.get('/thumbnails/small/missing.jpg')
+                self.assertEquals(result.status_code, 404)
+                result = client.get('/thumbnails/small/{}'.format(
+                    filename.replace('.', '.middle.', 1)))
+                self.assertEquals(result.status_code, 404)
+
+                broken = '{}.jpg'.format(uuid.uuid4())
+                with open(os.path.join(settings.MEDIA_ROOT, broken), 'wb') as f:
+                    f.write(b'not an image')
+                try:
+                    result = client.get('/thumbnails/small/{}'.format(broken))
+                    self.assertEquals(result.status_code, 404)
+                finally:
+                    os.remove(os.path.join(settings.MEDIA_ROOT, broken))
+        finally:
+            shutil.rmtree(cache_root)
+
+    def testThumbnailEncodings(self):
+        file = io.BytesIO()
+        # EXIF block with orientation 6: stored sideways, displayed rotated 90 degrees
+        exif = (b'Exif\x00\x00MM\x00*\x00\x00\x00\x08\x00\x01'
+                b'\x01\x12\x00\x03\x00\x00\x00\x01\x00\x06\x00\x00\x00\x00\x00\x00')
+        Image.new('RGB', size=(200, 100), color=(155, 0, 0)).save(file, 'jpeg', exif=exif)
+        file.name = 'rotated.jpg'
+        file.seek(0)
+        client = APIClient()
+        url = '/api-v1/albums/{}/photos/?session_key={}'.format(self.album1_id, self.session1_key)
+        result = client.post(url, {'orig_file': file})
+        self.assertEquals(result.status_code, 201)
+
+        result = client.get(url)
+        small = os.path.basename(result.data[0]['thumbnails']['small'])
+        self.assertTrue(small.endswith('.jpg'))
+        with Image.open(os.path.join(settings.MEDIA_ROOT, small)) as image:
+            self.assertEqual(image.format, 'JPEG')
+            self.assertEqual(image.size, (100, 200))
+            self.assertNotIn('exif', image.info)
+
+        Image.init()
+        if 'WEBP' in Image.SAVE:
+            result = client.get(url + '&image_accept=image/webp')
+            small = os.path.basename(result.data[0]['thumbnails']['small'])
+            self.assertTrue(small.endswith('.webp'))
+            with Image.open(os.path.join(settings.MEDIA_ROOT, small)) as image:
+                self.assertEqual(image.format, 'WEBP')
+
+        # Representations differing by accepted image types don't share validators
+        result = client.get(url, HTTP_ACCEPT='application/json')
+        etag = result['ETag']
+        result = client.get(url, HTTP_ACCEPT='application/json, image/webp',
+                            HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(result.status_code, 200)
+        self.assertNotEquals(result['ETag'], etag)
+        self.assertIn('Accept', result['Vary'])
+
+    def testBackfillThumbnails(self):
+        from django.core.management import call_command
+        from albums.mappings import Photo
+        client = APIClient()
+        url = '/api-v1/albums/{}/photos/?session_key={}'.format(self.album1_id, self.session1_key)
+        for i in range(3):
+            result = client.post(url, {'orig_file': generate_image_file()})
+            self.assertEquals(result.status_code, 201)
+
+        directory = tempfile.mkdtemp()
+        checkpoint = os.path.join(directory, 'checkpoint.json')
+        sizes = dict(settings.THUMBNAIL_SIZES, tiny=(50, 50))
+        try:
+            with self.settings(THUMBNAIL_SIZES=sizes):
+                call_command('backfill_thumbnails', batch_size=2, workers=2,
+                             checkpoint=checkpoint, stdout=io.StringIO())
+                Session.remove()
+                for thumbnails, in Session().query(Photo.thumbnails):
+                    with Image.open(os.path.join(settings.MEDIA_ROOT, thumbnails['tiny'])) as image:
+                        self.assertLessEqual(max(image.size), 50)
+
+                out = io.StringIO()
+                call_command('backfill_thumbnails', batch_size=2, restart=True, stdout=out)
+                self.assertIn('3 photos (', out.getvalue())
+                self.assertIn('0 rows updated', out.getvalue())
+                out = io.StringIO()
+                call_command('backfill_thumbnails', checkpoint=checkpoint, stdout=out)
+                self.assertIn('Resuming after', out.getvalue())
+                self.assertIn('0 photos (', out.getvalue())
+
+                # A corrupt original is counted and skipped, the run goes on
+                orig_file, = Session().query(Photo.orig_file).first()
+                Session.remove()
+                with open(os.path.join(settings.MEDIA_ROOT, orig_file), 'wb') as f:
+                    f.write(b'not an image')
+                out = io.StringIO()
+                call_command('backfill_thumbnails', batch_size=2, restart=True, force=True,
+                             stdout=out)
+                self.assertIn('1 unreadable', out.getvalue())
+                self.assertIn('3 photos (', out.getvalue())
+        finally:
+            shutil.rmtree(directory)
+
+    def testCoalescedThumbnailWrites(self):
+        import json
+        import socket
+        from albums.mappings import Photo
+        from albums.thumbnail_store import ThumbnailPathBuffer
+        client = APIClient()
+        url = '/api-v1/albums/{}/photos/?session_key={}'.format(self.album1_id, self.session1_key)
+        photos = []
+        for i in range(3):
+            result = client.post(url, {'orig_file': generate_image_file()})
+            self.assertEquals(result.status_code, 201)
+            photos.append((result.data['id'], os.path.basename(result.data['orig_file'])))
+
+        def stored():
+            Session.remove()
+            return {str(photo_id): thumbnails for photo_id, thumbnails
+                    in Session().query(Photo.id, Photo.thumbnails)}
+
+        journal_dir = tempfile.mkdtemp()
+        try:
+            with self.settings(THUMBNAIL_STORE_BATCH_SIZE=2, THUMBNAIL_STORE_BATCH_DELAY=60,
+                               THUMBNAIL_STORE_JOURNAL_DIR=journal_dir):
+                # Journal of a killed worker, nobody holds its lock
+                with open(os.path.join(journal_dir, 'host-1.journal'), 'w') as f:
+                    photo_id, orig_file = photos[0]
+                    f.write(json.dumps([photo_id, orig_file, {'fullsize': orig_file}]) + '\n')
+                    f.write('["truncated')
+                buffer = ThumbnailPathBuffer()
+                photo_id, orig_file = photos[1]
+                buffer.add(photo_id, orig_file, {'fullsize': orig_file, 'marker': 'buffered'})
+                self.assertEqual(os.listdir(journal_dir),
+                                 ['{}-{}.journal'.format(socket.gethostname(), os.getpid())])
+                rows = stored()
+                self.assertEqual(rows[photos[0][0]], {'fullsize': photos[0][1]})
+                self.assertEqual(rows[photos[1][0]]['marker'], 'buffered')
+
+                photo_id, orig_file = photos[2]
+                buffer.add(photo_id, orig_file, {'fullsize': orig_file, 'marker': 'buffered'})
+                self.assertIn('small', stored()[photo_id])
+                buffer.add(photo_id, 'replaced.jpg', {'fullsize': 'replaced.jpg'})
+                buffer.flush()
+                self.assertIn('small', stored()[photo_id])
+        finally:
+            shutil.rmtree(journal_dir)
+
+    def testDigestEmails(self):
+        from unittest import mock
+        from albums.tasks import send_digest_email
+        client = APIClient()
+        url = '/api-v1/albums/{}/photos/?session_key={}'.format(self.album1_id, self.session1_key)
+        with self.settings(UPLOAD_EMAIL_DIGEST_WINDOW=60), \
+                mock.patch.object(send_digest_email, 'apply_async') as schedule:
+            for i in range(3):
+                result = client.post(url, {'orig_file': generate_image_file()})
+                self.assertEquals(result.status_code, 201)
+            self.assertEqual(len(mail.outbox), 0)
+            schedule.assert_called_once_with((self.user1_id,), countdown=60)
+
+            send_digest_email(self.user1_id)
+            self.assertEqual(len(mail.outbox), 1)
+            self.assertIn('Your 3 photos', mail.outbox[0].body)
+            send_digest_email(self.user1_id)
+            self.assertEqual(len(mail.outbox), 1)
+
+    def testMailConnectionReconnects(self):
+        from django.core.mail import EmailMessage
+        from albums.mail import MailConnection
+        DroppingEmailBackend.opened = 0
+        connection = MailConnection('albums.tests.DroppingEmailBackend')
+        for i in range(3):
+            connection.send_messages([EmailMessage('Subject', 'Body', 'from@mysite.com',
+                                                   ['to@mysite.com'])])
+        self.assertEqual(DroppingEmailBackend.opened, 2)
+        self.assertEqual(len(mail.outbox), 3)
+
+    def testMalformedAlbumId(self):
+        client = APIClient()
+        result = client.post(
+            '/api-v1/albums/{}/photos/?session_key={}'.format('not-a-uuid', self.session1_key),
+            {'orig_file': generate_image_file(), 'description': ''})
+        self.assertEquals(result.status_code, 403)
+        self.assertEqual(len(mail.outbox), 0)
@@ -0,0 +1,151 @@
+"""
+On-demand thumbnails: sizes are rendered on first request into a
+size-bounded disk cache. Least recently used files (by mtime, refreshed on
+every hit) are evicted once the cache grows past THUMBNAIL_CACHE_MAX_BYTES.
+Concurrent requests for the same missing thumbnail render it once: threads
+of a process share a lock per thumbnail, processes serialize on one of
+LOCK_BUCKETS lock files picked by the thumbnail's name.
+"""
+
+import fcntl
+import os
+import threading
+import zlib
+
+from django.conf import settings
+
+from .thumbnails import (format_for_filename, render_thumbnails, save_thumbnail,
+                         size_encodings, thumbnail_filename)
+
+# Fraction of THUMBNAIL_CACHE_MAX_BYTES kept after an eviction pass
+EVICT_TO = 0.9
+LOCK_BUCKETS = 64
+LOCKS_DIR = '.locks'
+
+
+class ThumbnailCache:
+
+    def __init__(self):
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._written = 0
+        self._evict_lock = threading.Lock()
+
+    @property
+    def root(self):
+        return settings.THUMBNAIL_CACHE_ROOT
+
+    @property
+    def max_bytes(self):
+        return settings.THUMBNAIL_CACHE_MAX_BYTES
+
+    def _key_lock(self, key):
+        with self._locks_lock:
+            lock, users = self._locks.get(key, (None, 0))
+            if lock is None:
+                lock = threading.Lock()
+            self._locks[key] = (lock, users + 1)
+            return lock
+
+    def _release_key_lock(self, key):
+        with self._locks_lock:
+            lock, users = self._locks[key]
+            if users <= 1:
+                del self._locks[key]
+            else:
+                self._locks[key] = (lock, users - 1)
+
+    def get(self, filename, size_name, encoding=None):
+        """
+        Returns the path of filename's size_name thumbnail in the given
+        encoding (one of size_encodings(size_name)), rendering it if it isn't
+        cached. Raises FileNotFoundError if the original is missing.
+        """
+        path = os.path.join(self.root, thumbnail_filename(filename, size_name, encoding))
+        if self._touch(path):
+            return path
+        lock = self._key_lock(path)
+        try:
+            with lock:
+                if not self._touch(path):
+                    self._render_locked(filename, size_name, encoding, path)
+        finally:
+            self._release_key_lock(path)
+        return path
+
+    def _touch(self, path):
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _render_locked(self, filename, size_name, encoding, path):
+        lock_dir = os.path.join(self.root, LOCKS_DIR)
+        os.makedirs(lock_dir, exist_ok=True)
+        bucket = zlib.crc32(path.encode('utf-8')) % LOCK_BUCKETS
+        with open(os.path.join(lock_dir, '{}.lock'.format(bucket)), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Another process may have rendered it meanwhile
+            if self._touch(path):
+                return
+            original = os.path.join(settings.MEDIA_ROOT, filename)
+            size = settings.THUMBNAIL_SIZES[size_name]
+            partial = '{}.{}.part'.format(path, os.getpid())
+            try:
+                for name, image in render_thumbnails(original, {size_name: size}):
+                    save_thumbnail(image, partial, encoding, format=format_for_filename(path))
+                os.replace(partial, path)
+            finally:
+                if os.path.exists(partial):
+                    os.remove(partial)
+        self._written += os.path.getsize(path)
+        if self._written >= self.max_bytes * (1 - EVICT_TO):
+            self.evict()
+
+    def discard(self, filename):
+        """
+        Removes cached thumbnails of a deleted original
+        """
+        for size_name in settings.THUMBNAIL_SIZES:
+            cached = {thumbnail_filename(filename, size_name, encoding)
+                      for encoding in size_encodings(size_name) + [None]}
+            for name in cached:
+                try:
+                    os.remove(os.path.join(self.root, name))
+                except FileNotFoundError:
+                    pass
+
+    def evict(self):
+        """
+        Removes least recently used thumbnails until the cache fits
+        """
+        if not self._evict_lock.acquire(blocking=False):
+            return
+        try:
+            self._written = 0
+            entries = []
+            total = 0
+            with os.scandir(self.root) as it:
+                for entry in it:
+                    if not entry.is_file() or entry.name.endswith('.part'):
+                        continue
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+            if total <= self.max_bytes:
+                return
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= self.max_bytes * EVICT_TO:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+        finally:
+            self._evict_lock.release()
+
+
+thumbnail_cache = ThumbnailCache()
@@ -0,0 +1,242 @@
+"""
+Coalesced writes of Photo.thumbnails.
+
+Finished uploads are buffered per worker process and stored by one
+executemany UPDATE once THUMBNAIL_STORE_BATCH_SIZE results are pending or
+the oldest one waited THUMBNAIL_STORE_BATCH_DELAY seconds. Every buffered
+result is first appended to the process' journal in
+THUMBNAIL_STORE_JOURNAL_DIR, which the process keeps flock()ed. Journals
+left unlocked by a killed worker are taken over by the next process which
+buffers a result or starts. A journal is truncated once its results are
+stored.
+"""
+
+import atexit
+import fcntl
+import json
+import logging
+import os
+import socket
+import threading
+from collections import OrderedDict
+from uuid import UUID
+
+from django.conf import settings
+from sqlalchemy import and_, bindparam
+
+from sa_helper import Session
+from .mappings import Photo
+
+JOURNAL_SUFFIX = '.journal'
+
+logger = logging.getLogger(__name__)
+
+
+def write_thumbnail_paths(entries):
+    """
+    Stores [(photo_id, orig_file, thumbnails)] with one executemany UPDATE,
+    without reading the rows. Rows deleted or given another file meanwhile
+    are left alone.
+    """
+    if not entries:
+        return
+    table = Photo.__table__
+    statement = (table.update()
+                 .where(and_(table.c.id == bindparam('photo_id'),
+                             table.c.orig_file == bindparam('photo_orig_file')))
+                 .values(thumbnails=bindparam('photo_thumbnails')))
+    sa_session = Session()
+    try:
+        sa_session.execute(statement, [{'photo_id': UUID(str(photo_id)),
+                                        'photo_orig_file': orig_file,
+                                        'photo_thumbnails': thumbnails}
+                                       for photo_id, orig_file, thumbnails in entries])
+        sa_session.commit()
+    except Exception:
+        sa_session.rollback()
+        raise
+
+
+def _read_journal(journal):
+    journal.seek(0)
+    entries = []
+    for line in journal:
+        try:
+            entries.append(tuple(json.loads(line)))
+        except ValueError:
+            # Last line of a journal whose writer was killed mid-write
+            continue
+    return entries
+
+
+class ThumbnailPathBuffer:
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()
+        self._journal = None
+        self._pid = None
+        self._timer = None
+        atexit.register(self.flush)
+
+    @property
+    def batch_size(self):
+        return getattr(settings, 'THUMBNAIL_STORE_BATCH_SIZE', 0)
+
+    @property
+    def delay(self):
+        return getattr(settings, 'THUMBNAIL_STORE_BATCH_DELAY', 1.0)
+
+    @property
+    def journal_dir(self):
+        return settings.THUMBNAIL_STORE_JOURNAL_DIR
+
+    def _ensure_process(self):
+        """
+        Opens this process' journal, forgetting state inherited through
+        fork(), and takes over journals of dead processes
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        # Entries and the timer belong to the parent, which stores them itself
+        self._entries = OrderedDict()
+        self._timer = None
+        os.makedirs(self.journal_dir, exist_ok=True)
+        path = os.path.join(self.journal_dir, '{}-{}{}'.format(socket.gethostname(), pid,
+                                                               JOURNAL_SUFFIX))
+        while True:
+            journal = open(path, 'a+')
+            fcntl.flock(journal, fcntl.LOCK_EX)
+            # Another process' _recover may have taken the file over and
+            # removed it between open() and flock(), keep the one at path
+            try:
+                current = os.stat(path)
+            except FileNotFoundError:
+                current = None
+            opened = os.fstat(journal.fileno())
+            if current is not None and (current.st_dev, current.st_ino) == (opened.st_dev, opened.st_ino):
+                break
+            journal.close()
+        self._journal, self._pid = journal, pid
+        # A dead process with the same pid may have left entries behind
+        for photo_id, orig_file, thumbnails in _read_journal(journal):
+            self._entries[photo_id] = (orig_file, thumbnails)
+        self._recover(path)
+
+    def _recover(self, own_path):
+        for name in os.listdir(self.journal_dir):
+            path = os.path.join(self.journal_dir, name)
+            if not name.endswith(JOURNAL_SUFFIX) or path == own_path:
+                continue
+            try:
+                journal = open(path, 'r')
+            except FileNotFoundError:
+                continue
+            with journal:
+                try:
+                    fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Its process is alive
+                    continue
+                for photo_id, orig_file, thumbnails in _read_journal(journal):
+                    self._entries.setdefault(photo_id, (orig_file, thumbnails))
+                # Recovered entries are journaled here before the dead journal goes
+                self._rewrite_journal()
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _append_journal(self, photo_id, orig_file, thumbnails):
+        self._journal.write(json.dumps([photo_id, orig_file, thumbnails]) + '\n')
+        self._journal.flush()
+
+    def _rewrite_journal(self):
+        self._journal.seek(0)
+        self._journal.truncate()
+        for photo_id, (orig_file, thumbnails) in self._entries.items():
+            self._journal.write(json.dumps([photo_id, orig_file, thumbnails]) + '\n')
+        self._journal.flush()
+
+    def add(self, photo_id, orig_file, thumbnails):
+        """
+        Buffers a result, stores the buffer once it's full
+        """
+        with self._lock:
+            self._ensure_process()
+            self._append_journal(photo_id, orig_file, thumbnails)
+            self._entries.pop(photo_id, None)
+            self._entries[photo_id] = (orig_file, thumbnails)
+            if len(self._entries) >= self.batch_size:
+                self._try_flush_locked()
+            else:
+                self._schedule_locked()
+
+    def recover(self):
+        """
+        Stores results journaled by dead processes
+        """
+        with self._lock:
+            self._ensure_process()
+            self._schedule_locked()
+
+    def flush(self):
+        with self._lock:
+            if self._pid == os.getpid() and self._entries:
+                self._flush_locked()
+
+    def _schedule_locked(self):
+        if self._timer is None and self._entries:
+            self._timer = threading.Timer(self.delay, self._flush_from_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_from_timer(self):
+        try:
+            with self._lock:
+                self._timer = None
+                if self._pid == os.getpid():
+                    self._try_flush_locked()
+        finally:
+            Session.remove()
+
+    def _try_flush_locked(self):
+        try:
+            self._flush_locked()
+        except Exception:
+            # Entries stay buffered and journaled, the timer retries
+            logger.exception('Storing %d thumbnails failed', len(self._entries))
+            self._schedule_locked()
+
+    def _flush_locked(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        write_thumbnail_paths([(photo_id, orig_file, thumbnails)
+                               for photo_id, (orig_file, thumbnails) in self._entries.items()])
+        self._entries.clear()
+        self._journal.seek(0)
+        self._journal.truncate()
+
+
+thumbnail_path_buffer = ThumbnailPathBuffer()
+
+
+def _flush_on_shutdown(**kwargs):
+    thumbnail_path_buffer.flush()
+
+
+def _recover_on_start(**kwargs):
+    thumbnail_path_buffer.recover()
+
+
+def connect_worker_signals():
+    """
+    Stores buffered results when a worker process stops and replays
+    journals of killed ones when it starts
+    """
+    from celery import signals
+    signals.worker_process_init.connect(_recover_on_start, weak=False)
+    signals.worker_process_shutdown.connect(_flush_on_shutdown, weak=False)
+    signals.worker_shutdown.connect(_flush_on_shutdown, weak=False)
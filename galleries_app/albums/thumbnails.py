@@ -0,0 +1,294 @@
+"""
+Thumbnail rendering: the original is decoded once, JPEGs at a reduced DCT
+scale (Image.draft) when every target size is much smaller, and each size
+is downscaled from the previous, larger result where that one covers it.
+
+Thumbnails are rotated upright according to the original's EXIF
+orientation and written without metadata. THUMBNAIL_ENCODINGS configures
+the formats written per size: the first encoding is the primary one,
+stored under the size name, the others are variants picked by clients
+accepting their media type.
+"""
+
+import os
+import threading
+
+from django.conf import settings
+from PIL import Image
+
+VARIANTS_KEY = 'variants'
+
+FORMAT_EXTENSIONS = {'JPEG': '.jpg', 'WEBP': '.webp', 'PNG': '.png', 'GIF': '.gif'}
+FORMAT_MEDIA_TYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp',
+                      'PNG': 'image/png', 'GIF': 'image/gif'}
+
+EXIF_ORIENTATION = 0x0112
+# EXIF orientation -> transpositions turning the image upright
+ORIENTATION_TRANSPOSE = {
+    2: (Image.FLIP_LEFT_RIGHT,),
+    3: (Image.ROTATE_180,),
+    4: (Image.FLIP_TOP_BOTTOM,),
+    5: (Image.TRANSPOSE,),
+    6: (Image.ROTATE_270,),
+    7: (Image.TRANSVERSE,),
+    8: (Image.ROTATE_90,),
+}
+# Orientations whose upright image has width and height swapped
+SWAPPED_ORIENTATIONS = (5, 6, 7, 8)
+# Pixels a rendered thumbnail may differ from the computed size, reduced
+# JPEG decoding and cascaded downscaling round differently
+SIZE_TOLERANCE = 2
+
+
+def thumbnail_filename(filename, size_name, encoding=None):
+    basename, ext = os.path.splitext(filename)
+    if encoding is not None:
+        ext = FORMAT_EXTENSIONS[encoding['format']]
+    return '{}.{}{}'.format(basename, size_name, ext)
+
+
+def format_for_filename(filename):
+    Image.init()
+    return Image.EXTENSION[os.path.splitext(filename)[1].lower()]
+
+
+def _can_save(format):
+    Image.init()
+    return format in Image.SAVE
+
+
+def size_encodings(size_name):
+    """
+    Returns the encodings configured for size_name, primary first, skipping
+    formats this Pillow build can't write. [None] keeps the original's format.
+    """
+    config = getattr(settings, 'THUMBNAIL_ENCODINGS', None) or {}
+    encodings = config.get(size_name, config.get('default'))
+    encodings = [encoding for encoding in encodings or () if _can_save(encoding['format'])]
+    return encodings or [None]
+
+
+def media_type(encoding, filename):
+    format = encoding['format'] if encoding is not None else format_for_filename(filename)
+    return FORMAT_MEDIA_TYPES.get(format, 'application/octet-stream')
+
+
+def accepted_media_types(accept):
+    """
+    Returns media types an Accept header value explicitly allows
+    """
+    result = set()
+    for item in accept.split(','):
+        media_type, *params = [part.strip() for part in item.split(';')]
+        if any(param.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+               for param in params):
+            continue
+        if media_type:
+            result.add(media_type.lower())
+    return result
+
+
+def negotiate_encoding(encodings, accepted):
+    """
+    Picks the first variant encoding whose media type is accepted,
+    the primary encoding otherwise
+    """
+    for encoding in encodings[1:]:
+        if FORMAT_MEDIA_TYPES[encoding['format']] in accepted:
+            return encoding
+    return encodings[0]
+
+
+def thumbnail_files(thumbnails):
+    """
+    Returns every filename in a stored thumbnails map, variants included
+    """
+    filenames = [filename for key, filename in thumbnails.items() if key != VARIANTS_KEY]
+    for variants in thumbnails.get(VARIANTS_KEY, {}).values():
+        filenames.extend(variants.values())
+    return filenames
+
+
+def _flatten(image):
+    """
+    Converts modes JPEG can't store to RGB, transparency over white
+    """
+    if image.mode == 'P':
+        image = image.convert('RGBA')
+    if image.mode in ('RGBA', 'LA'):
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        return background
+    return image.convert('RGB')
+
+
+def save_thumbnail(image, path, encoding, format=None):
+    """
+    Writes image with the given encoding, None keeps format (by default
+    the one of path's extension) with Pillow's default options
+    """
+    if encoding is None:
+        image.save(path, format=format or format_for_filename(path))
+        return
+    options = dict(encoding)
+    format = options.pop('format')
+    if format == 'JPEG' and image.mode not in ('RGB', 'L', 'CMYK'):
+        image = _flatten(image)
+    image.save(path, format=format, **options)
+
+
+def _orientation(image):
+    try:
+        exif = image._getexif() if hasattr(image, '_getexif') else None
+    except Exception:
+        # Broken EXIF blocks shouldn't fail the upload
+        return None
+    if not exif:
+        return None
+    return exif.get(EXIF_ORIENTATION)
+
+
+def lazy_sizes(thumbnails):
+    """
+    Returns size names missing from a stored thumbnails map, which the
+    on-demand thumbnail view serves when THUMBNAIL_LAZY is on
+    """
+    if not getattr(settings, 'THUMBNAIL_LAZY', False) or 'fullsize' not in thumbnails:
+        return []
+    return [size_name for size_name in settings.THUMBNAIL_SIZES if size_name not in thumbnails]
+
+
+def _fit(image_size, size):
+    """
+    Returns the size Image.thumbnail(size) produces for image_size
+    """
+    x, y = image_size
+    if x > size[0]:
+        y = int(max(y * size[0] / x, 1))
+        x = int(size[0])
+    if y > size[1]:
+        x = int(max(x * size[1] / y, 1))
+        y = int(size[1])
+    return x, y
+
+
+def _covers(image, target):
+    return image.size[0] >= target[0] and image.size[1] >= target[1]
+
+
+def render_thumbnails(path, sizes, image_info=None):
+    """
+    Yields (size_name, image) for every {size_name: (width, height)} entry,
+    largest first, rotated upright. image_info parsed while uploading spares
+    reading the EXIF block again.
+    """
+    if not sizes:
+        return
+    with Image.open(path) as original:
+        if image_info is not None:
+            orientation = image_info.get('orientation')
+        else:
+            orientation = _orientation(original)
+        transpositions = ORIENTATION_TRANSPOSE.get(orientation, ())
+        if orientation in SWAPPED_ORIENTATIONS:
+            # Fit the stored image into the box it fills once rotated
+            sizes = {name: (size[1], size[0]) for name, size in sizes.items()}
+        ordered = sorted(sizes.items(), key=lambda item: item[1][0] * item[1][1], reverse=True)
+        targets = [(name, _fit(original.size, size)) for name, size in ordered]
+        original.draft(original.mode, (max(t[0] for _, t in targets),
+                                       max(t[1] for _, t in targets)))
+        original.load()
+        previous = None
+        for name, target in targets:
+            source = previous if previous is not None and _covers(previous, target) else original
+            image = source.copy()
+            image.info.pop('exif', None)
+            image.thumbnail(target)
+            previous = image
+            for method in transpositions:
+                image = image.transpose(method)
+            yield name, image
+
+
+def thumbnails_map(filename, size_names):
+    """
+    Returns the thumbnails map stored for filename rendered in size_names
+    with the configured encodings
+    """
+    result = {}
+    variants = {}
+    for size_name in size_names:
+        primary, *others = size_encodings(size_name)
+        result[size_name] = thumbnail_filename(filename, size_name, primary)
+        for encoding in others:
+            name = thumbnail_filename(filename, size_name, encoding)
+            variants.setdefault(size_name, {})[media_type(encoding, name)] = name
+    result['fullsize'] = filename
+    if variants:
+        result[VARIANTS_KEY] = variants
+    return result
+
+
+def write_thumbnails(filename, sizes, image_info=None):
+    """
+    Renders {size_name: (width, height)} thumbnails of MEDIA_ROOT/filename
+    in every configured encoding. Files are replaced atomically, thumbnails
+    being served keep their old content until the new one is complete.
+    """
+    path = os.path.join(settings.MEDIA_ROOT, filename)
+    for size_name, image in render_thumbnails(path, sizes, image_info):
+        for encoding in size_encodings(size_name):
+            path = os.path.join(settings.MEDIA_ROOT, thumbnail_filename(filename, size_name, encoding))
+            partial = '{}.{}-{}.part'.format(path, os.getpid(), threading.get_ident())
+            try:
+                save_thumbnail(image, partial, encoding, format=format_for_filename(path))
+                os.replace(partial, path)
+            finally:
+                if os.path.exists(partial):
+                    os.remove(partial)
+
+
+def _upright_size(image):
+    if _orientation(image) in SWAPPED_ORIENTATIONS:
+        return image.size[1], image.size[0]
+    return image.size
+
+
+def _rendered_as(path, encoding, expected_size):
+    try:
+        with Image.open(path) as image:
+            format, size = image.format, image.size
+    except (OSError, SyntaxError):
+        return False
+    if encoding is not None and format != encoding['format']:
+        return False
+    return (abs(size[0] - expected_size[0]) <= SIZE_TOLERANCE
+            and abs(size[1] - expected_size[1]) <= SIZE_TOLERANCE)
+
+
+def stale_sizes(filename, thumbnails):
+    """
+    Returns size names whose thumbnails of MEDIA_ROOT/filename are missing
+    from the stored map or on disk, or don't match the configured size and
+    encodings. Only image headers are read, so changed quality or other
+    save options of an encoding go unnoticed. Raises FileNotFoundError if
+    the original is missing.
+    """
+    expected = thumbnails_map(filename, settings.THUMBNAIL_SIZES)
+    thumbnails = thumbnails or {}
+    with Image.open(os.path.join(settings.MEDIA_ROOT, filename)) as original:
+        upright = _upright_size(original)
+    result = []
+    for size_name, box in settings.THUMBNAIL_SIZES.items():
+        stored_variants = thumbnails.get(VARIANTS_KEY, {}).get(size_name)
+        if (thumbnails.get(size_name) != expected[size_name]
+                or stored_variants != expected.get(VARIANTS_KEY, {}).get(size_name)):
+            result.append(size_name)
+            continue
+        target = _fit(upright, box)
+        for encoding in size_encodings(size_name):
+            path = os.path.join(settings.MEDIA_ROOT, thumbnail_filename(filename, size_name, encoding))
+            if not _rendered_as(path, encoding, target):
+                result.append(size_name)
+                break
+    return result
@@ -0,0 +1,192 @@
+"""
+Streams photo uploads straight into MEDIA_ROOT.
+
+Django's default handlers spool an upload to memory or a temp file which
+FileSystemStorage then copies into place. MediaStreamingUploadHandler
+writes request chunks to a partial file next to its final location,
+hashing them and parsing the image header on the way, and renames it into
+place once the upload completes.
+"""
+
+import hashlib
+import io
+import os
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+from PIL import Image
+
+from .file_storage import (content_addressed_filename, generate_uuid4_filename,
+                           is_content_addressed, stored_file_lock)
+
+EXIF_ORIENTATION = 0x0112
+
+
+def _image_info(image):
+    info = {'width': image.size[0], 'height': image.size[1],
+            'format': image.format, 'mode': image.mode, 'orientation': None}
+    try:
+        exif = image._getexif() if hasattr(image, '_getexif') else None
+    except Exception:
+        exif = None
+    if exif:
+        info['orientation'] = exif.get(EXIF_ORIENTATION)
+    return info
+
+
+class StoredUploadedFile(UploadedFile):
+    """
+    Upload already stored in MEDIA_ROOT as stored_name. The stored file is
+    only opened if something reads the upload's content.
+
+    :ivar sha256: Hex digest of the content
+    :ivar image_info: Dimensions, format, mode and EXIF orientation parsed
+                      from the header, None if it isn't a recognized image
+    :ivar created: False when a content-addressed file already existed
+    :ivar spare_path: Copy of the content kept when the file already
+                      existed, until restore() knows it wasn't deleted
+                      meanwhile
+    """
+
+    def __init__(self, stored_name, name, content_type, size, charset,
+                 content_type_extra, sha256, image_info, created=True, spare_path=None):
+        self._file = None
+        self.stored_name = stored_name
+        self.created = created
+        self.spare_path = spare_path
+        self.sha256 = sha256
+        self.image_info = image_info
+        super().__init__(None, name, content_type, size, charset, content_type_extra)
+
+    @property
+    def path(self):
+        return os.path.join(settings.MEDIA_ROOT, self.stored_name)
+
+    @property
+    def file(self):
+        if self._file is None:
+            self._file = open(self.path, 'rb')
+        return self._file
+
+    @file.setter
+    def file(self, value):
+        self._file = value
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+    def restore(self):
+        """
+        Puts a reused content-addressed file back if its last Photo row
+        was deleted between file_complete and this upload's commit, and
+        drops the spare copy. Returns True if it was put back, the file's
+        thumbnails are gone then too.
+        """
+        if self.spare_path is None:
+            return False
+        with stored_file_lock(self.stored_name):
+            restored = not os.path.exists(self.path)
+            if restored:
+                os.replace(self.spare_path, self.path)
+        self.remove_spare()
+        return restored
+
+    def remove_spare(self):
+        if self.spare_path is not None:
+            try:
+                os.remove(self.spare_path)
+            except FileNotFoundError:
+                pass
+            self.spare_path = None
+
+    def discard(self):
+        """
+        Removes the stored file, for uploads rejected after streaming.
+        Content-addressed files may be shared and are left to reference
+        counting (see albums.viewsets.release_photo_files).
+        """
+        self.close()
+        self.remove_spare()
+        if not self.created or is_content_addressed():
+            return
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class MediaStreamingUploadHandler(FileUploadHandler):
+    """
+    Writes each uploaded file to MEDIA_ROOT/<uuid4><ext> atomically, or to
+    MEDIA_ROOT/<sha256><ext> with PHOTO_CONTENT_ADDRESSED_STORAGE
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
+        self.stored_name = generate_uuid4_filename(self.file_name)
+        self.partial_path = os.path.join(settings.MEDIA_ROOT, '.{}.part'.format(self.stored_name))
+        self.out = open(self.partial_path, 'wb')
+        self.sha256 = hashlib.sha256()
+        self.header = bytearray()
+        self.image_info = None
+
+    def _parse_header(self, raw_data):
+        # Image.open only reads the header, pixel data is never decoded here
+        self.header += raw_data
+        try:
+            with Image.open(io.BytesIO(self.header)) as image:
+                self.image_info = _image_info(image)
+        except Exception:
+            if len(self.header) >= getattr(settings, 'PHOTO_UPLOAD_HEADER_LIMIT', 1024 * 1024):
+                self.header = None
+        else:
+            self.header = None
+
+    def receive_data_chunk(self, raw_data, start):
+        self.out.write(raw_data)
+        self.sha256.update(raw_data)
+        if self.header is not None:
+            self._parse_header(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        self.out.close()
+        sha256 = self.sha256.hexdigest()
+        created = True
+        spare_path = None
+        path = os.path.join(settings.MEDIA_ROOT, self.stored_name)
+        if is_content_addressed():
+            self.stored_name = content_addressed_filename(sha256, self.file_name)
+            path = os.path.join(settings.MEDIA_ROOT, self.stored_name)
+            with stored_file_lock(self.stored_name):
+                created = not os.path.exists(path)
+                if created:
+                    os.replace(self.partial_path, path)
+            if not created:
+                # Kept until the Photo row commits, the existing file may be
+                # deleted with its last row before that
+                spare_path = self.partial_path
+        else:
+            os.replace(self.partial_path, path)
+        return StoredUploadedFile(
+            stored_name=self.stored_name,
+            name=self.file_name,
+            content_type=self.content_type,
+            size=file_size,
+            charset=self.charset,
+            content_type_extra=self.content_type_extra,
+            sha256=sha256,
+            image_info=self.image_info,
+            created=created,
+            spare_path=spare_path)
+
+    def upload_interrupted(self):
+        if getattr(self, 'out', None) is not None:
+            self.out.close()
+            try:
+                os.remove(self.partial_path)
+            except FileNotFoundError:
+                pass
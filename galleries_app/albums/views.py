@@ -0,0 +1,35 @@
+import os
+
+from django.conf import settings
+from django.http import FileResponse, Http404
+from django.utils.cache import patch_vary_headers
+from django.views.decorators.http import require_safe
+from PIL import Image
+
+from .file_storage import is_original_filename
+from .thumbnail_cache import thumbnail_cache
+from .thumbnails import accepted_media_types, media_type, negotiate_encoding, size_encodings
+
+
+@require_safe
+def thumbnail(request, size_name, filename):
+    """
+    Serves a photo's thumbnail in the best encoding the client accepts,
+    rendering it on first access
+    """
+    # Only stored originals, never thumbnails or other MEDIA_ROOT files
+    if (size_name not in settings.THUMBNAIL_SIZES
+            or os.path.basename(filename) != filename or not is_original_filename(filename)):
+        raise Http404
+    encodings = size_encodings(size_name)
+    encoding = negotiate_encoding(encodings, accepted_media_types(request.META.get('HTTP_ACCEPT', '')))
+    try:
+        path = thumbnail_cache.get(filename, size_name, encoding)
+    except (OSError, SyntaxError, KeyError, Image.DecompressionBombError):
+        # Missing or not an image
+        raise Http404
+    response = FileResponse(open(path, 'rb'), content_type=media_type(encoding, filename))
+    response['Cache-Control'] = 'public, max-age={}'.format(60 * 60 * 24)
+    if len(encodings) > 1:
+        patch_vary_headers(response, ('Accept',))
+    return response
@@ -1,17 +1,30 @@
 from uuid import UUID
 
 from django.conf import settings
+from django.urls import reverse
+from django.utils.encoding import iri_to_uri
+from PIL import Image
+from sqlalchemy import false
 
-from rest_framework import viewsets, serializers, parsers
+from rest_framework import viewsets, serializers, parsers, status
+from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated, SAFE_METHODS
+from rest_framework.response import Response
 
 from sa_helper import Session
+
 from sa_helper.viewsets import ViewSetModelMixin, SerializerModelMixin
 from users.auth import SessionIdAuthentication
 
 from .mappings import Album, Photo
-from .file_storage import save_uploaded_photo
-from .tasks import process_upload
+from .file_storage import (delete_photo_files, is_content_addressed, save_uploaded_photo,
+                           stored_file_lock)
+from .ownership import AlbumOwnership
+from .thumbnail_cache import thumbnail_cache
+from .thumbnails import (FORMAT_MEDIA_TYPES, VARIANTS_KEY, accepted_media_types, lazy_sizes,
+                         thumbnail_files)
+from .upload_handlers import MediaStreamingUploadHandler, StoredUploadedFile
+from .tasks import process_upload, process_upload_batch, send_email, send_batch_email
 
 
 class AlbumSerializer(SerializerModelMixin, serializers.Serializer):
@@ -30,6 +43,7 @@ class AlbumSerializer(SerializerModelMixin, serializers.Serializer):
         return instance
 
     def update(self, instance, validated_data, **kwargs):
+        instance = super().update(instance, validated_data)
         instance.user_id = UUID(self.context['request'].user.id)
         return instance
 
@@ -46,7 +60,45 @@ class AlbumViewSet(ViewSetModelMixin, viewsets.ViewSet):
     def apply_qs_filters(self, qs, **kwargs):
         return qs.filter(Album.user_id == self.request.user.id)
 
+def media_url_builder(request):
+    """
+    Returns filename -> absolute media URL function, equal to
+    request.build_absolute_uri(settings.MEDIA_URL + filename) but resolving
+    the scheme and host once
+    """
+    prefix = request.build_absolute_uri(settings.MEDIA_URL)
+
+    def build(filename):
+        if '/' in filename:
+            return request.build_absolute_uri(settings.MEDIA_URL + filename)
+        return prefix + iri_to_uri(filename)
+    return build
+
+
 class ImageField(serializers.ImageField):
+    def to_internal_value(self, data):
+        if isinstance(data, StoredUploadedFile):
+            # The header was parsed while streaming, only the integrity
+            # check Django's ImageField does is left
+            if data.image_info is None:
+                data.discard()
+                self.fail('invalid_image')
+            try:
+                with Image.open(data.path) as image:
+                    image.verify()
+            except Exception:
+                data.discard()
+                self.fail('invalid_image')
+            return data
+        return super().to_internal_value(data)
+
+    def compile_representation(self):
+        request = self.context.get('request', None)
+        if request is None:
+            return None
+        build = media_url_builder(request)
+        return lambda value: build(value) if value else None
+
     def to_representation(self, value):
         if not value:
             return None
@@ -56,7 +108,63 @@ class ImageField(serializers.ImageField):
         return value
 
 
+def client_image_types(request):
+    """
+    Returns image media types the client accepts: those of its Accept
+    header and of the comma separated image_accept query param, for
+    clients whose Accept header describes the API response
+    """
+    accepted = accepted_media_types(request.META.get('HTTP_ACCEPT', ''))
+    accepted.update(accepted_media_types(request.GET.get('image_accept', '')))
+    return {media_type for media_type in accepted if media_type.startswith('image/')}
+
+
+def thumbnails_url_builder(request):
+    """
+    Returns thumbnails map -> {size_name: absolute URL} function. Sizes
+    with a variant in a media type the client accepts link the variant,
+    sizes served on demand (see lazy_sizes) point at the thumbnail view.
+    """
+    build_media_url = media_url_builder(request)
+    accepted = client_image_types(request)
+    view_prefixes = {}
+
+    def view_prefix(size_name):
+        if size_name not in view_prefixes:
+            url = reverse('thumbnail', kwargs={'size_name': size_name, 'filename': 'x'})
+            view_prefixes[size_name] = request.build_absolute_uri(url[:-1])
+        return view_prefixes[size_name]
+
+    def build(value):
+        urls = {key: build_media_url(filename) for key, filename in value.items()
+                if key != VARIANTS_KEY}
+        if accepted:
+            for size_name, variants in value.get(VARIANTS_KEY, {}).items():
+                for media_type, filename in variants.items():
+                    if media_type in accepted:
+                        urls[size_name] = build_media_url(filename)
+                        break
+        for size_name in lazy_sizes(value):
+            urls[size_name] = view_prefix(size_name) + iri_to_uri(value['fullsize'])
+        return urls
+    return build
+
+
 class ThumbnailsJSONField(serializers.JSONField):
+    def compile_representation(self):
+        request = self.context.get('request', None)
+        if request is None or self.binary:
+            return None
+        build = thumbnails_url_builder(request)
+
+        def convert(value):
+            if not value:
+                return None
+            if 'status' in value:
+                return value
+            return build(value)
+        return convert
+
     def to_representation(self, value):
         value = super().to_representation(value)
         if not value:
@@ -65,11 +173,36 @@ class ThumbnailsJSONField(serializers.JSONField):
             return value
         request = self.context.get('request', None)
         if request is not None:
-            return {key:request.build_absolute_uri(settings.MEDIA_URL + filename)
-                    for key, filename in value.items()}
+            return thumbnails_url_builder(request)(value)
         return value
 
 
+def rendered_thumbnails(orig_file):
+    """
+    Returns thumbnails already rendered for a stored file, None if there are none
+    """
+    query = Session().query(Photo.thumbnails).filter(Photo.orig_file == orig_file)
+    for thumbnails, in query:
+        if thumbnails and 'status' not in thumbnails:
+            return thumbnails
+    return None
+
+
+def release_photo_files(orig_file, thumbnails):
+    """
+    Deletes a photo's files once no Photo row references them. Uploads
+    reusing the file meanwhile put it back (see StoredUploadedFile.restore).
+    """
+    with stored_file_lock(orig_file):
+        if Session().query(Photo.id).filter(Photo.orig_file == orig_file).first() is not None:
+            return
+        filenames = {orig_file}
+        if thumbnails and 'status' not in thumbnails:
+            filenames.update(thumbnail_files(thumbnails))
+        delete_photo_files(filenames)
+    thumbnail_cache.discard(orig_file)
+
+
 class PhotoSerializer(SerializerModelMixin, serializers.Serializer):
     model = Photo
 
@@ -80,7 +213,14 @@ class PhotoSerializer(SerializerModelMixin, serializers.Serializer):
     def _process_file(self, instance, validated_data):
         upfile = validated_data['orig_file']
         instance.orig_file = save_uploaded_photo(upfile)
-
+        instance.image_info = getattr(upfile, 'image_info', None)
+        instance.upload = upfile if isinstance(upfile, StoredUploadedFile) else None
+        # Identical content stored before, its thumbnails need no rendering
+        instance.reused_thumbnails = None
+        if is_content_addressed():
+            instance.reused_thumbnails = rendered_thumbnails(instance.orig_file)
+            if instance.reused_thumbnails is not None:
+                instance.thumbnails = instance.reused_thumbnails
 
     def create(self, validated_data, **kwargs):
         instance = super().create(validated_data, **kwargs)
@@ -89,6 +229,7 @@ class PhotoSerializer(SerializerModelMixin, serializers.Serializer):
         return instance
 
     def update(self, instance, validated_data, **kwargs):
+        instance.replaced_files = (instance.orig_file, instance.thumbnails)
         instance = super().update(instance, validated_data, **kwargs)
         self._process_file(instance, validated_data)
         return instance
@@ -97,10 +238,8 @@ class PhotoAlbumPermission(IsAuthenticated):
     def has_permission(self, request, view):
         result = super().has_permission(request, view)
         if result and request.method not in SAFE_METHODS:
-            return Session().query(Album).filter(
-                Album.id == view.kwargs['parent_lookup_object_id'],
-                Album.user_id == request.user.id
-            ).first() is not None
+            album_id = view.kwargs['parent_lookup_object_id']
+            return AlbumOwnership.of(request).owned_album_id(album_id) is not None
         else:
             return result
 
@@ -108,6 +247,7 @@ class PhotoAlbumPermission(IsAuthenticated):
 class PhotoViewSet(ViewSetModelMixin, viewsets.ViewSet):
     """
     Album's photos CRUD operations.
+    POST bulk/: uploads many photos, one orig_file part per photo.
     Requires auth via session_key url param
     """
     authentication_classes = (SessionIdAuthentication,)
@@ -115,13 +255,134 @@ class PhotoViewSet(ViewSetModelMixin, viewsets.ViewSet):
     serializer_class = PhotoSerializer
     parser_classes = (parsers.MultiPartParser, parsers.FormParser,)
 
+    def initialize_request(self, request, *args, **kwargs):
+        request.upload_handlers = [MediaStreamingUploadHandler(request)]
+        return super().initialize_request(request, *args, **kwargs)
+
     def apply_qs_filters(self, qs, **kwargs):
-        return (qs.filter(Photo.album_id == UUID(kwargs['parent_lookup_object_id']))
+        album_id = kwargs['parent_lookup_object_id']
+        ownership = AlbumOwnership.of(self.request)
+        if ownership.is_resolved(album_id):
+            # Already proven by PhotoAlbumPermission, no need to join Album again
+            owned_album_id = ownership.owned_album_id(album_id)
+            if owned_album_id is None:
+                return qs.filter(false())
+            return qs.filter(Photo.album_id == owned_album_id)
+        return (qs.filter(Photo.album_id == UUID(album_id))
                   .join(Album)
                   .filter(Album.user_id == self.request.user.id))
 
     def kwargs_to_validated_data(self, kwargs):
-        return {'album_id': UUID(kwargs['parent_lookup_object_id'])}
+        album_id = kwargs['parent_lookup_object_id']
+        return {'album_id': AlbumOwnership.of(self.request).owned_album_id(album_id)}
+
+    def get_representation_variant(self, request):
+        # Thumbnail URLs link the variants of image types the client accepts
+        return tuple(sorted(client_image_types(request) & set(FORMAT_MEDIA_TYPES.values())))
 
     def post_save(self, request):
-        process_upload(str(self.obj.id), str(request.user.id), self.obj.orig_file)
+        # A reused file deleted before the commit is back, its thumbnails aren't
+        if self.obj.upload is not None and self.obj.upload.restore():
+            self.obj.reused_thumbnails = None
+        if self.obj.reused_thumbnails is not None:
+            send_email.delay(self.obj.reused_thumbnails, str(request.user.id))
+        else:
+            process_upload(str(self.obj.id), str(request.user.id), self.obj.orig_file,
+                           self.obj.image_info)
+        replaced_file, replaced_thumbnails = getattr(self.obj, 'replaced_files', (None, None))
+        if replaced_file is not None and replaced_file != self.obj.orig_file:
+            release_photo_files(replaced_file, replaced_thumbnails)
+
+    def discard_uploads(self, request, keep=()):
+        """
+        Removes files streamed in with the request which no Photo row
+        stores, e.g. extra orig_file parts or uploads of a failed save
+        """
+        for name, upfiles in request.FILES.lists():
+            for upfile in upfiles:
+                if not isinstance(upfile, StoredUploadedFile) or upfile.stored_name in keep:
+                    continue
+                upfile.discard()
+                if upfile.created and is_content_addressed():
+                    # Other uploads of the same content may store it by now
+                    release_photo_files(upfile.stored_name, None)
+
+    def _saved_files(self, response):
+        if (response is not None and self.obj is not None
+                and response.status_code in (status.HTTP_200_OK, status.HTTP_201_CREATED)):
+            return {self.obj.orig_file}
+        return set()
+
+    def create(self, request, **kwargs):
+        response = None
+        try:
+            response = super().create(request, **kwargs)
+        finally:
+            self.discard_uploads(request, keep=self._saved_files(response))
+        return response
+
+    def _update(self, request, pk, partial=False, **kwargs):
+        response = None
+        try:
+            response = super()._update(request, pk, partial=partial, **kwargs)
+        finally:
+            self.discard_uploads(request, keep=self._saved_files(response))
+        return response
+
+    def pre_destroy(self, request):
+        self.released_files = (self.obj.orig_file, self.obj.thumbnails)
+
+    def post_destroy(self, request):
+        release_photo_files(*self.released_files)
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request, **kwargs):
+        files = request.FILES.getlist('orig_file')
+        if not files:
+            return Response({'orig_file': ['No file was submitted.']},
+                            status=status.HTTP_400_BAD_REQUEST)
+        max_files = getattr(settings, 'PHOTO_BULK_UPLOAD_MAX_FILES', 500)
+        if len(files) > max_files:
+            return Response({'orig_file': ['At most {} files per request.'.format(max_files)]},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        photo_serializers = [self.serializer_class(data={'orig_file': upfile},
+                                                   context={'request': request})
+                             for upfile in files]
+        if not all([serializer.is_valid() for serializer in photo_serializers]):
+            self.discard_uploads(request)
+            return Response([serializer.errors for serializer in photo_serializers],
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        validated_data = self.kwargs_to_validated_data(kwargs)
+        photos = [serializer.save(**validated_data) for serializer in photo_serializers]
+        # Read before commit expires the instances
+        data = [serializer.data for serializer in photo_serializers]
+        uploads = [(str(photo.id), photo.orig_file, photo.image_info, photo.reused_thumbnails,
+                    photo.upload) for photo in photos]
+
+        sa_session = Session()
+        sa_session.add_all(photos)
+        try:
+            sa_session.commit()
+        except Exception as e:
+            sa_session.rollback()
+            self.discard_uploads(request)
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        # Parts streamed in but not stored by any row, e.g. duplicates of one file
+        self.discard_uploads(request, keep={orig_file for _, orig_file, _, _, _ in uploads})
+        reused, photo_ids, filenames, image_infos = [], [], [], []
+        for photo_id, orig_file, image_info, reused_thumbnails, upload in uploads:
+            # A reused file deleted before the commit is back, its thumbnails aren't
+            restored = upload is not None and upload.restore()
+            if reused_thumbnails is not None and not restored:
+                reused.append(reused_thumbnails)
+            else:
+                photo_ids.append(photo_id)
+                filenames.append(orig_file)
+                image_infos.append(image_info)
+        if photo_ids:
+            process_upload_batch(photo_ids, str(request.user.id), filenames, reused, image_infos)
+        else:
+            send_batch_email.delay(reused, str(request.user.id))
+        return Response(data, status=status.HTTP_201_CREATED)
@@ -20,6 +20,7 @@ from rest_framework_extensions.routers import ExtendedDefaultRouter
 
 from users.viewsets import UserViewSet, AuthViewSet
 from albums.viewsets import AlbumViewSet, PhotoViewSet
+from albums.views import thumbnail
 
 router = ExtendedDefaultRouter()
 router.register(r'users', UserViewSet, basename='user')
@@ -34,6 +35,7 @@ router.register(r'auth', AuthViewSet, basename='auth')
 # Additionally, we include login URLs for the browsable API.
 urlpatterns = [
     url(r'^api-v1/', include(router.urls)),
+    url(r'^thumbnails/(?P<size_name>[\w-]+)/(?P<filename>[^/]+)$', thumbnail, name='thumbnail'),
 ]
 
 if settings.DEBUG:
@@ -1,17 +1,83 @@
+import time
 from importlib import import_module
 from django.conf import settings
+from django.contrib.sessions.backends.base import VALID_KEY_CHARS
+from django.core.cache import cache
 from rest_framework.authentication import BaseAuthentication
 
+from .lru import LRUCache
+
+SESSION_CACHE_PREFIX = 'session-auth:'
+# Cached value for keys without an authenticated user
+ANONYMOUS = ''
+
+_local_sessions = LRUCache(getattr(settings, 'SESSION_AUTH_LOCAL_SIZE', 10000),
+                           getattr(settings, 'SESSION_AUTH_LOCAL_TTL', 5))
+
+
 def get_django_session_store():
     return import_module(settings.SESSION_ENGINE).SessionStore
 
+def _cache_user_id(key, user_id, expires_at=None):
+    """
+    Caches (user id, session expiry timestamp), never past the session's expiry
+    """
+    ttl = getattr(settings, 'SESSION_AUTH_CACHE_TTL', 60)
+    if expires_at is not None:
+        ttl = min(ttl, int(expires_at - time.time()))
+        if ttl <= 0:
+            return
+    entry = (user_id if user_id is not None else ANONYMOUS, expires_at)
+    cache.set(SESSION_CACHE_PREFIX + key, entry, ttl)
+    _local_sessions.set(key, entry)
+
+def _unexpired(entry):
+    # Entries of another format (older releases) count as misses
+    if not isinstance(entry, tuple):
+        return False
+    value, expires_at = entry
+    return expires_at is None or expires_at > time.time()
+
 def create_session_key(user_id):
     store = get_django_session_store()
     s = store()
     s['user_id'] = user_id
+    # Kept in the session, Django's stores don't expose when a loaded session expires
+    s['expires_at'] = time.time() + s.get_expiry_age()
     s.create()
+    _cache_user_id(s.session_key, user_id, s['expires_at'])
     return s.session_key
 
+def delete_session_key(key):
+    """
+    Logs the session out and drops it from the auth caches.
+    Other processes' local caches forget it within SESSION_AUTH_LOCAL_TTL.
+    """
+    store = get_django_session_store()
+    store(session_key=key).delete()
+    cache.delete(SESSION_CACHE_PREFIX + key)
+    _local_sessions.delete(key)
+
+def get_session_user_id(key):
+    """
+    Resolves a session key to user id via in-process LRU, then Django's
+    cache, then the session store
+    """
+    if not key or not set(key).issubset(VALID_KEY_CHARS):
+        return None
+    entry = _local_sessions.get(key)
+    if entry is not None and _unexpired(entry):
+        return entry[0] or None
+    entry = cache.get(SESSION_CACHE_PREFIX + key)
+    if entry is not None and _unexpired(entry):
+        _local_sessions.set(key, entry)
+        return entry[0] or None
+    store = get_django_session_store()
+    session = store(session_key=key)
+    user_id = session.get('user_id', None)
+    _cache_user_id(key, user_id, session.get('expires_at', None))
+    return user_id
+
 class AuthUser:
     id = None
     is_authenticated = False
@@ -34,6 +100,4 @@ class SessionIdAuthentication(BaseAuthentication):
         return self.authenticate_credentials(session_id)
 
     def authenticate_credentials(self, key):
-        store = get_django_session_store()
-        session = store(session_key=key)
-        return AuthUser(session.get('user_id', None)), key
+        return AuthUser(get_session_user_id(key)), key
@@ -0,0 +1,189 @@
+"""
+Client of the catalogues service resolving country and eye color ids.
+
+Lookups are batched into one POST <resource>/lookup/ per call over
+keep-alive connections pooled per process, and results (unknown ids
+included) are kept in a local TTL cache. After CATALOGUES_FAILURE_THRESHOLD
+consecutive failures the client stops calling the service for
+CATALOGUES_RESET_TIMEOUT seconds, callers get no representations meanwhile
+and fall back to bare ids.
+"""
+
+import http.client
+import json
+import os
+import queue
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
+from django.conf import settings
+
+from .lru import LRUCache
+
+# Cached for ids the service doesn't know
+UNKNOWN = object()
+# Ids per lookup request, the service's max_lookup_ids
+LOOKUP_BATCH_SIZE = 1000
+# Fields of catalogue entries not embedded: URLs point at the internal service
+INTERNAL_FIELDS = ('url',)
+
+
+class CatalogueUnavailable(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Opens after threshold consecutive failures, lets one trial call
+    through reset_timeout seconds later
+    """
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial_in_flight or time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            # Half-open: callers are refused until the trial call reports
+            self._trial_in_flight = True
+            return True
+
+    def succeeded(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def failed(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.threshold:
+                self._opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+class CatalogueClient:
+
+    def __init__(self, base_url, timeout, pool_size, cache_ttl, cache_size,
+                 failure_threshold, reset_timeout):
+        url = urlsplit(base_url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.path = url.path.rstrip('/')
+        self.timeout = timeout
+        self.cache = LRUCache(cache_size, cache_ttl)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._pid = os.getpid()
+
+    def _connection(self):
+        if self._pid != os.getpid():
+            # Sockets inherited through fork() are the parent's
+            self._pool = queue.LifoQueue(maxsize=self._pool.maxsize)
+            self._pid = os.getpid()
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _release(self, connection):
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def _post(self, path, payload):
+        body = json.dumps(payload).encode('utf-8')
+        headers = {'Content-Type': 'application/json', 'Accept': 'application/json'}
+        # A pooled connection may have been closed by the server while idle
+        for attempt in range(2):
+            connection = self._connection()
+            reused = connection.sock is not None
+            try:
+                connection.request('POST', self.path + path, body, headers)
+                response = connection.getresponse()
+                content = response.read()
+            except (http.client.HTTPException, OSError) as e:
+                connection.close()
+                if reused and attempt == 0 and not isinstance(e, socket.timeout):
+                    continue
+                raise CatalogueUnavailable(str(e))
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(connection)
+            if response.status != 200:
+                raise CatalogueUnavailable('{} {}'.format(response.status, response.reason))
+            return json.loads(content.decode('utf-8'))
+
+    def lookup(self, resource, ids):
+        """
+        Returns {id: representation} for the ids of a catalogue resource
+        ('countries', 'eye-colors') the service knows. Ids are resolved
+        from the cache where possible, the rest with one request per
+        LOOKUP_BATCH_SIZE ids. Raises CatalogueUnavailable.
+        """
+        result = {}
+        missing = []
+        for pk in {str(pk) for pk in ids}:
+            cached = self.cache.get((resource, pk))
+            if cached is None:
+                missing.append(pk)
+            elif cached is not UNKNOWN:
+                result[pk] = cached
+        if not missing:
+            return result
+        if not self.breaker.allow():
+            raise CatalogueUnavailable('Circuit open')
+        try:
+            for start in range(0, len(missing), LOOKUP_BATCH_SIZE):
+                batch = missing[start:start + LOOKUP_BATCH_SIZE]
+                found = {item['id']: {name: value for name, value in item.items()
+                                      if name not in INTERNAL_FIELDS}
+                         for item in self._post('/{}/lookup/'.format(resource), {'ids': batch})}
+                for pk in batch:
+                    self.cache.set((resource, pk), found.get(pk, UNKNOWN))
+                result.update(found)
+        except Exception as e:
+            # Any failure reports, a half-open breaker's trial must end
+            self.breaker.failed()
+            if isinstance(e, (ValueError, KeyError, TypeError, AttributeError)):
+                raise CatalogueUnavailable('Malformed response')
+            raise
+        self.breaker.succeeded()
+        return result
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_catalogue_client():
+    """
+    Returns the process' client of settings.CATALOGUES_URL
+    """
+    base_url = settings.CATALOGUES_URL
+    client = _clients.get(base_url)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(base_url)
+            if client is None:
+                client = _clients[base_url] = CatalogueClient(
+                    base_url,
+                    timeout=getattr(settings, 'CATALOGUES_TIMEOUT', 0.5),
+                    pool_size=getattr(settings, 'CATALOGUES_POOL_SIZE', 10),
+                    cache_ttl=getattr(settings, 'CATALOGUES_CACHE_TTL', 300),
+                    cache_size=getattr(settings, 'CATALOGUES_CACHE_SIZE', 10000),
+                    failure_threshold=getattr(settings, 'CATALOGUES_FAILURE_THRESHOLD', 5),
+                    reset_timeout=getattr(settings, 'CATALOGUES_RESET_TIMEOUT', 30))
+    return client
@@ -0,0 +1,127 @@
+"""
+Login cost control: password hash verification runs on a small bounded
+thread pool (pbkdf2 releases the GIL, so this caps the CPU logins can take),
+requests beyond the pool's queue are rejected with 429 right away, and
+repeated failures per email and per client IP are throttled before any
+hashing is done.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from rest_framework.exceptions import Throttled
+
+from .lru import LRUCache
+
+
+class LoginAttempts:
+    """
+    Failure counters per key within a sliding-from-first-failure window,
+    kept in a bounded LRU so a flood of distinct keys can't grow memory
+    """
+
+    def __init__(self, max_size):
+        self._failures = LRUCache(max_size)
+        self._lock = threading.Lock()
+
+    def _window(self):
+        return getattr(settings, 'LOGIN_FAILURE_WINDOW', 300)
+
+    def retry_after(self, key, limit):
+        """
+        Returns seconds until key may try again, None if it may now
+        """
+        entry = self._failures.get(key)
+        if entry is None:
+            return None
+        failures, started = entry
+        if failures < limit:
+            return None
+        return max(started + self._window() - time.monotonic(), 0) or None
+
+    def failed(self, key):
+        window = self._window()
+        with self._lock:
+            failures, started = self._failures.get(key, (0, time.monotonic()))
+            self._failures.set(key, (failures + 1, started),
+                               ttl=max(started + window - time.monotonic(), 0))
+
+    def reset(self, key):
+        self._failures.delete(key)
+
+    def clear(self):
+        self._failures.clear()
+
+
+class BoundedVerifier:
+    """
+    Runs verification callables on max_workers threads with at most
+    max_pending calls queued or running
+    """
+
+    def __init__(self, max_workers, max_pending):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            raise Throttled(detail='Too many concurrent login attempts.')
+        try:
+            future = self._executor.submit(func, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future.result()
+
+
+attempts = LoginAttempts(getattr(settings, 'LOGIN_ATTEMPTS_TRACKED', 10000))
+_verifier = None
+_verifier_lock = threading.Lock()
+
+
+def get_verifier():
+    global _verifier
+    if _verifier is None:
+        with _verifier_lock:
+            if _verifier is None:
+                _verifier = BoundedVerifier(getattr(settings, 'LOGIN_VERIFY_WORKERS', 2),
+                                            getattr(settings, 'LOGIN_VERIFY_MAX_PENDING', 8))
+    return _verifier
+
+
+def _keys(email, ip):
+    return (('email:' + email.lower(), getattr(settings, 'LOGIN_MAX_FAILURES', 10)),
+            ('ip:' + (ip or ''), getattr(settings, 'LOGIN_MAX_FAILURES_PER_IP', 100)))
+
+
+def check_login_allowed(email, ip):
+    """
+    Raises Throttled while the email or IP is over its failure limit
+    """
+    for key, limit in _keys(email, ip):
+        wait = attempts.retry_after(key, limit)
+        if wait is not None:
+            raise Throttled(wait=wait)
+
+
+def verify_password(password, candidate, email, ip):
+    """
+    Compares a PasswordType value with candidate on the bounded pool and
+    records the outcome
+    """
+    valid = get_verifier().run(password.__eq__, candidate)
+    email_key, ip_key = (key for key, limit in _keys(email, ip))
+    if valid is True:
+        attempts.reset(email_key)
+    else:
+        attempts.failed(email_key)
+        attempts.failed(ip_key)
+    return valid is True
+
+
+def login_failed(email, ip):
+    for key, limit in _keys(email, ip):
+        attempts.failed(key)
@@ -1,10 +1,10 @@
 from sqlalchemy import Column, String
 from sqlalchemy_utils import UUIDType, EmailType, PasswordType, force_auto_coercion
-from sa_helper import BaseMapping
+from sa_helper import BaseMapping, Versioned
 
 force_auto_coercion()
 
-class User(BaseMapping):
+class User(Versioned, BaseMapping):
     __tablename__ = 'user'
 
     id = Column(UUIDType, primary_key=True)
@@ -1,9 +1,47 @@
 import os
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
 from django.conf import settings
 from django.test import SimpleTestCase, override_settings
 from rest_framework.test import APIClient
 from sa_helper import Session
 
+COUNTRY_ID = str(uuid.uuid4())
+
+
+class CataloguesStubHandler(BaseHTTPRequestHandler):
+    """
+    Answers catalogue lookups like the catalogues service, over keep-alive
+    """
+    protocol_version = 'HTTP/1.1'
+    requests = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        ids = json.loads(body.decode('utf-8'))['ids']
+        CataloguesStubHandler.requests.append((self.path, ids))
+        found = [{'id': pk, 'name': 'Country', 'description': '',
+                  'url': 'http://catalogues:8001/api-v1/countries/{}/'.format(pk)}
+                 for pk in ids if pk == COUNTRY_ID and self.path.endswith('/countries/lookup/')]
+        content = json.dumps(found).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
 @override_settings(SA_DATABASE_URL = 'sqlite:///test.db')
 class BaseTestCase(SimpleTestCase):
 
@@ -120,3 +158,163 @@ class UserTestCase(BaseTestCase):
         del user2_data['password']
         self.assertCollectionContains(result.data, user1_data2)
         self.assertCollectionContains(result.data, user2_data)
+
+    def testSessionRemovedAfterRequest(self):
+        client = APIClient()
+        client.post('/api-v1/users/', {'name': 'user1 name',
+                                       'last_name': 'user1 last',
+                                       'father_name': 'user1 father',
+                                       'password': 'pass1',
+                                       'email': 'user1@localhost'})
+        self.assertFalse(Session.registry.has())
+        client.get('/api-v1/users/')
+        self.assertFalse(Session.registry.has())
+
+    def testStreamingList(self):
+        client = APIClient()
+        for i in range(2):
+            client.post('/api-v1/users/', {'name': 'user{} name'.format(i),
+                                           'last_name': 'last',
+                                           'father_name': 'father',
+                                           'password': 'pass',
+                                           'email': 'user{}@localhost'.format(i)})
+        result = client.get('/api-v1/users/?stream=1')
+        self.assertEquals(result.status_code, 200)
+        self.assertTrue(result.streaming)
+        data = json.loads(b''.join(result.streaming_content).decode('utf-8'))
+        self.assertEquals(len(data), 2)
+        self.assertCollectionContains(data, {'name': 'user1 name', 'email': 'user1@localhost'})
+
+        result = client.get('/api-v1/users/', HTTP_ACCEPT='application/x-ndjson')
+        self.assertEquals(result.status_code, 200)
+        self.assertEquals(result['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(result.streaming_content).decode('utf-8').splitlines()
+        self.assertEquals(len(lines), 2)
+        self.assertCollectionContains([json.loads(line) for line in lines],
+                                      {'name': 'user0 name'})
+
+    def testLogout(self):
+        client = APIClient()
+        client.post('/api-v1/users/', {'name': 'user1 name',
+                                       'last_name': 'user1 last',
+                                       'father_name': 'user1 father',
+                                       'password': 'pass1',
+                                       'email': 'user1@localhost'})
+        result = client.post('/api-v1/auth/', {'email': 'user1@localhost',
+                                               'password': 'pass1'})
+        session_key = result.data['session_key']
+        result = client.get('/api-v1/auth/?session_key={}'.format(session_key))
+        self.assertIsNotNone(result.data['user_id'])
+
+        result = client.post('/api-v1/auth/logout/?session_key={}'.format(session_key))
+        self.assertEquals(result.status_code, 200)
+        result = client.get('/api-v1/auth/?session_key={}'.format(session_key))
+        self.assertIsNone(result.data['user_id'])
+        result = client.post('/api-v1/auth/logout/?session_key={}'.format(session_key))
+        self.assertEquals(result.status_code, 403)
+
+    @override_settings(SESSION_COOKIE_AGE=2)
+    def testSessionExpiryBoundsAuthCache(self):
+        client = APIClient()
+        client.post('/api-v1/users/', {'name': 'user1 name',
+                                       'last_name': 'user1 last',
+                                       'father_name': 'user1 father',
+                                       'password': 'pass1',
+                                       'email': 'user1@localhost'})
+        result = client.post('/api-v1/auth/', {'email': 'user1@localhost',
+                                               'password': 'pass1'})
+        session_key = result.data['session_key']
+        result = client.get('/api-v1/auth/?session_key={}'.format(session_key))
+        self.assertIsNotNone(result.data['user_id'])
+
+        time.sleep(2.1)
+        result = client.get('/api-v1/auth/?session_key={}'.format(session_key))
+        self.assertIsNone(result.data['user_id'])
+
+    @override_settings(LOGIN_MAX_FAILURES=2)
+    def testLoginFailuresThrottled(self):
+        from users.login_guard import attempts
+        client = APIClient()
+        client.post('/api-v1/users/', {'name': 'user1 name',
+                                       'last_name': 'user1 last',
+                                       'father_name': 'user1 father',
+                                       'password': 'pass1',
+                                       'email': 'user1@localhost'})
+        try:
+            for i in range(2):
+                result = client.post('/api-v1/auth/', {'email': 'user1@localhost',
+                                                       'password': 'wrong'})
+                self.assertEquals(result.status_code, 403)
+            result = client.post('/api-v1/auth/', {'email': 'user1@localhost',
+                                                   'password': 'pass1'})
+            self.assertEquals(result.status_code, 429)
+        finally:
+            attempts.clear()
+        result = client.post('/api-v1/auth/', {'email': 'user1@localhost',
+                                               'password': 'pass1'})
+        self.assertEquals(result.status_code, 200)
+
+    def testCircuitBreakerSingleTrial(self):
+        from users.catalogues import CircuitBreaker
+        breaker = CircuitBreaker(threshold=2, reset_timeout=0)
+        breaker.failed()
+        self.assertTrue(breaker.allow())
+        breaker.failed()
+        # Half-open: one trial call, the others are refused until it reports
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.failed()
+        self.assertTrue(breaker.allow())
+        breaker.succeeded()
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+
+    def testExpandCatalogues(self):
+        client = APIClient()
+        for i, country_id in enumerate((COUNTRY_ID, str(uuid.uuid4()), None)):
+            data = {'name': 'user name', 'last_name': 'user last', 'father_name': 'user father',
+                    'password': 'pass', 'email': 'user{}@localhost'.format(i)}
+            if country_id is not None:
+                data['country_id'] = country_id
+            result = client.post('/api-v1/users/', data)
+            self.assertEquals(result.status_code, 201)
+
+        server = StubServer(('127.0.0.1', 0), CataloguesStubHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        CataloguesStubHandler.requests = []
+        url = 'http://127.0.0.1:{}/api-v1'.format(server.server_address[1])
+        try:
+            with self.settings(CATALOGUES_URL=url):
+                for i in range(2):
+                    result = client.get('/api-v1/users/?expand=country')
+                    self.assertEquals(result.status_code, 200)
+                    countries = {user['email']: user.get('country', 'absent') for user in result.data}
+                    self.assertEqual(countries['user0@localhost']['name'], 'Country')
+                    # Internal service URLs aren't published
+                    self.assertNotIn('url', countries['user0@localhost'])
+                    self.assertEqual(countries['user1@localhost'], 'absent')
+                    self.assertIsNone(countries['user2@localhost'])
+                # One batched lookup, the second list was served from the cache
+                self.assertEqual(len(CataloguesStubHandler.requests), 1)
+                self.assertEqual(len(CataloguesStubHandler.requests[0][1]), 2)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # Nothing listens there any more: lookups fail and users keep bare ids
+        unavailable = StubServer(('127.0.0.1', 0), CataloguesStubHandler)
+        unavailable.server_close()
+        url = 'http://127.0.0.1:{}/api-v1'.format(unavailable.server_address[1])
+        with self.settings(CATALOGUES_URL=url, CATALOGUES_TIMEOUT=0.1):
+            result = client.post('/api-v1/users/', {'name': 'user name', 'last_name': 'user last',
+                                                    'father_name': 'user father',
+                                                    'password': 'pass', 'email': 'new@localhost',
+                                                    'eyes_id': str(uuid.uuid4())})
+            result = client.get('/api-v1/users/{}/?expand=eyes'.format(result.data['id']))
+            self.assertEquals(result.status_code, 200)
+            self.assertNotIn('eyes', result.data)
+            self.assertIn('eyes_id', result.data)
+
+        result = client.get('/api-v1/users/?expand=password')
+        self.assertEquals(result.status_code, 400)
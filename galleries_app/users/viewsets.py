@@ -1,10 +1,14 @@
 from rest_framework import serializers, viewsets, status
+from rest_framework.decorators import action
+from rest_framework.exceptions import ParseError
 from rest_framework.response import Response
 
 from sa_helper import Session
 from sa_helper.viewsets import SerializerModelMixin, ViewSetModelMixin
 
-from .auth import create_session_key, SessionIdAuthentication
+from .auth import create_session_key, delete_session_key, SessionIdAuthentication
+from .catalogues import CatalogueUnavailable, get_catalogue_client
+from .login_guard import check_login_allowed, login_failed, verify_password
 from .mappings import User
 
 
@@ -32,10 +36,62 @@ class UserSerializer(SerializerModelMixin, serializers.Serializer):
 
 class UserViewSet(ViewSetModelMixin, viewsets.ViewSet):
     """
-    User profiles CRUD operations
+    User profiles CRUD operations.
+    ?expand=country,eyes embeds the catalogue entries of country_id/eyes_id
+    as country/eyes, left out while the catalogues service is unavailable
     """
 
     serializer_class = UserSerializer
+    # expand name -> (id field, catalogues resource)
+    expandable = {
+        'country': ('country_id', 'countries'),
+        'eyes': ('eyes_id', 'eye-colors'),
+    }
+
+    def get_expand(self, request):
+        names = [name for name in request.query_params.get('expand', '').split(',') if name]
+        unknown = [name for name in names if name not in self.expandable]
+        if unknown:
+            raise ParseError('Unknown expand: {}'.format(', '.join(unknown)))
+        return names
+
+    def expand(self, items, names):
+        """
+        Embeds catalogue entries into user representations, one lookup per resource
+        """
+        client = get_catalogue_client()
+        for name in names:
+            id_field, resource = self.expandable[name]
+            ids = {item[id_field] for item in items if item.get(id_field)}
+            try:
+                found = client.lookup(resource, ids) if ids else {}
+            except CatalogueUnavailable:
+                continue
+            for item in items:
+                pk = item.get(id_field)
+                if pk is None:
+                    item[name] = None
+                elif str(pk) in found:
+                    item[name] = found[str(pk)]
+
+    def is_conditional_read(self, request):
+        # Embedded entries change without the users' updated_at moving
+        return not self.get_expand(request) and super().is_conditional_read(request)
+
+    def list(self, request, **kwargs):
+        names = self.get_expand(request)
+        response = super().list(request, **kwargs)
+        if names and isinstance(response, Response) and response.status_code == status.HTTP_200_OK:
+            data = response.data
+            self.expand(data['results'] if isinstance(data, dict) else data, names)
+        return response
+
+    def retrieve(self, request, pk=None, **kwargs):
+        names = self.get_expand(request)
+        response = super().retrieve(request, pk, **kwargs)
+        if names:
+            self.expand([response.data], names)
+        return response
 
 
 class AuthSerializer(serializers.Serializer):
@@ -50,6 +106,7 @@ class AuthViewSet(viewsets.ViewSet):
     Users auth via email and password
     POST: Returns the session_key for the valid email & password pair
     GET: For the valid session_key in URL returns the authorised users's id, null otherwise
+    POST logout/: Invalidates the session_key passed in URL
     """
     authentication_classes = (SessionIdAuthentication,)
     serializer_class = AuthSerializer
@@ -65,10 +122,20 @@ class AuthViewSet(viewsets.ViewSet):
         serializer = AuthSerializer(data=request.data)
         if serializer.is_valid():
             data = serializer.save()
+            ip = request.META.get('REMOTE_ADDR')
+            check_login_allowed(data['email'], ip)
             user = sa_session.query(User).filter(User.email == data['email']).one_or_none()
-            if user and user.password == data['password']:
+            if user is None:
+                login_failed(data['email'], ip)
+            elif verify_password(user.password, data['password'], data['email'], ip):
                 return Response({'status': 'OK',
                                  'session_key': create_session_key(str(user.id))},
                                 status=status.HTTP_200_OK)
         return Response({'status': 'AUTH_ERROR'}, status=status.HTTP_403_FORBIDDEN)
 
+    @action(detail=False, methods=['post'])
+    def logout(self, request):
+        if not request.user.is_authenticated:
+            return Response({'status': 'AUTH_ERROR'}, status=status.HTTP_403_FORBIDDEN)
+        delete_session_key(request.auth)
+        return Response({'status': 'OK'}, status=status.HTTP_200_OK)
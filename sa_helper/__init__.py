@@ -1,24 +1,106 @@
 """
-Implements thread-local SA session reuse
+Implements thread-local SA session reuse on top of a single per-process engine
 """
 
+import os
+import threading
+
 from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
+from .pool import InstrumentedQueuePool, PoolStats, instrument_pool, pool_status
+from .versioning import Versioned
+
+# Options understood only by QueuePool, sqlite's default pools reject them
+QUEUE_POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout')
+
+_engine = None
+_engine_key = None
+_engine_lock = threading.Lock()
+_pool_stats = PoolStats()
+# Engines and sessions inherited from a parent process. Kept referenced so
+# garbage collection never closes sockets the parent is still using.
+_inherited = []
+
+
+def _engine_options(url, options):
+    options = dict(options)
+    statement_timeout = options.pop('statement_timeout', None)
+    backend = url.get_backend_name()
+    if backend == 'sqlite':
+        for name in QUEUE_POOL_OPTIONS:
+            options.pop(name, None)
+    else:
+        options.setdefault('poolclass', InstrumentedQueuePool)
+    if statement_timeout is not None and backend == 'postgresql':
+        connect_args = dict(options.get('connect_args', {}))
+        connect_args['options'] = '-c statement_timeout={:d}'.format(statement_timeout)
+        options['connect_args'] = connect_args
+    return options
+
+
+def _reset_after_fork():
+    """
+    Forgets the parent's engine and sessions without closing their connections
+    """
+    global _engine
+    if _engine is not None:
+        _inherited.append(_engine)
+    if Session.registry.has():
+        _inherited.append(Session.registry())
+        Session.registry.clear()
+    _engine = None
+    _pool_stats.reset()
+
+
 def get_engine():
     """
-    For lazy settings.SA_URL evaluation when Session()'s requested
+    Returns the process-wide engine, creating it on first use.
+
+    For lazy settings.SA_DATABASE_URL evaluation when Session()'s requested.
+    The engine is re-created in a forked child (Celery prefork, pre-fork WSGI
+    servers) and when SA_DATABASE_URL changes (e.g. override_settings in tests).
+    Pool configuration comes from settings.SA_ENGINE_OPTIONS: any
+    create_engine() keyword plus ``statement_timeout`` in milliseconds.
     """
+    global _engine, _engine_key
     from django.conf import settings
-    return create_engine(settings.SA_DATABASE_URL)
+    key = (os.getpid(), settings.SA_DATABASE_URL)
+    if _engine_key != key:
+        with _engine_lock:
+            if _engine_key != key:
+                if _engine_key is not None and _engine_key[0] != key[0]:
+                    _reset_after_fork()
+                elif _engine is not None:
+                    _engine.dispose()
+                url = make_url(settings.SA_DATABASE_URL)
+                options = _engine_options(url, getattr(settings, 'SA_ENGINE_OPTIONS', {}))
+                engine = create_engine(url, **options)
+                instrument_pool(engine.pool, _pool_stats)
+                _engine, _engine_key = engine, key
+    return _engine
+
+
+def get_pool_stats():
+    """
+    Returns pool occupancy and checkout/wait counters of this process' engine
+    """
+    result = {'pid': os.getpid()}
+    if _engine is not None:
+        result.update(pool_status(_engine.pool))
+    result.update(_pool_stats.as_dict())
+    return result
+
 
 def session_factory():
-    engine = get_engine()
-    fac = sessionmaker(bind=engine)
+    fac = sessionmaker(bind=get_engine())
     return fac()
 
 Session = scoped_session(session_factory)
 BaseMapping = declarative_base()
 
-__all__ = ['Session', 'BaseMapping', 'get_engine']
+default_app_config = 'sa_helper.apps.SaHelperConfig'
+
+__all__ = ['Session', 'BaseMapping', 'Versioned', 'get_engine', 'get_pool_stats']
@@ -0,0 +1,14 @@
+from django.apps import AppConfig
+
+
+class SaHelperConfig(AppConfig):
+    name = 'sa_helper'
+    verbose_name = 'SQLAlchemy helper'
+
+    def ready(self):
+        try:
+            import celery  # noqa: F401
+        except ImportError:
+            return
+        from .lifecycle import connect_celery_signals
+        connect_celery_signals()
@@ -0,0 +1,81 @@
+"""
+Request and task scoped SA session lifecycle
+"""
+
+from sqlalchemy.orm import sessionmaker
+
+from . import Session, get_engine
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def begin_readonly_session():
+    """
+    Installs an autocommit session as the current thread's Session().
+
+    Autocommit sessions never hold a transaction open between queries, so
+    the connection goes back to the pool as soon as each query is fetched.
+    Calling commit() on such a session raises, which is what read-only
+    request paths want.
+    """
+    remove_session()
+    Session.registry.set(sessionmaker(bind=get_engine(), autocommit=True)())
+
+
+def remove_session():
+    """
+    Ends the current thread's transaction, closes the session and returns
+    its connection to the pool. Uncommitted changes are rolled back.
+    """
+    if Session.registry.has():
+        Session.remove()
+
+
+class SASessionMiddleware:
+    """
+    Removes the thread-local SA session after every request.
+
+    With settings.SA_READONLY_SAFE_METHODS enabled GET/HEAD/OPTIONS requests
+    run on an autocommit session (see begin_readonly_session).
+    """
+
+    def __init__(self, get_response):
+        from django.conf import settings
+        self.get_response = get_response
+        self.readonly_safe_methods = getattr(settings, 'SA_READONLY_SAFE_METHODS', False)
+
+    def __call__(self, request):
+        if self.readonly_safe_methods and request.method in SAFE_METHODS:
+            begin_readonly_session()
+        try:
+            response = self.get_response(request)
+        except Exception:
+            remove_session()
+            raise
+        if response.streaming:
+            # Streamed bodies keep querying while the server iterates them
+            response._closable_objects.append(_SessionCloser())
+        else:
+            remove_session()
+        return response
+
+
+class _SessionCloser:
+    def close(self):
+        remove_session()
+
+
+def _on_task_finished(sender=None, **kwargs):
+    # Eager tasks run inside the caller's thread and share its session
+    if sender is not None and getattr(sender.request, 'is_eager', False):
+        return
+    remove_session()
+
+
+def connect_celery_signals():
+    """
+    Removes the thread-local SA session after each Celery task
+    """
+    from celery import signals
+    signals.task_postrun.connect(_on_task_finished, weak=False)
+    signals.task_failure.connect(_on_task_finished, weak=False)
@@ -0,0 +1,52 @@
+import time
+from itertools import cycle, islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+
+
+class Command(BaseCommand):
+    help = ('Compares DRF serializer and compiled read serializer rendering of '
+            'stored rows, checking that outputs are byte-identical')
+
+    def add_arguments(self, parser):
+        parser.add_argument('serializer', help='Dotted path, e.g. albums.viewsets.PhotoSerializer')
+        parser.add_argument('--rows', type=int, default=10000,
+                            help='Rows to render, stored rows are repeated to reach it')
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        from rest_framework.renderers import JSONRenderer
+        from rest_framework.request import Request
+        from rest_framework.test import APIRequestFactory
+        from sa_helper import Session
+        from sa_helper.read_serializers import compile_read_serializer
+
+        serializer_class = import_string(options['serializer'])
+        stored = Session().query(serializer_class.model).limit(options['rows']).all()
+        if not stored:
+            raise CommandError('No {} rows stored'.format(serializer_class.model.__name__))
+        rows = list(islice(cycle(stored), options['rows']))
+        context = {'request': Request(APIRequestFactory().get('/'))}
+        renderer = JSONRenderer()
+
+        def drf():
+            return serializer_class(rows, many=True, context=context).data
+
+        def compiled():
+            to_representation = compile_read_serializer(serializer_class, context)
+            return [to_representation(row) for row in rows]
+
+        if renderer.render(drf()) != renderer.render(compiled()):
+            raise CommandError('Compiled serializer output differs from DRF output')
+
+        for name, func in (('drf', drf), ('compiled', compiled)):
+            best = min(self._time(func) for _ in range(options['repeat']))
+            self.stdout.write('{:<10} {:>8} rows {:>10.1f} ms {:>12.0f} rows/s'.format(
+                name, len(rows), best * 1000, len(rows) / best))
+
+    @staticmethod
+    def _time(func):
+        started = time.perf_counter()
+        func()
+        return time.perf_counter() - started
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    help = 'Creates missing DB tables and adds missing columns and indexes to existing ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report columns and indexes which would be created')
+
+    def handle(self, *args, **options):
+        from sa_helper import get_engine, BaseMapping
+        from sa_helper.schema import sync_columns, sync_indexes
+        engine = get_engine()
+
+        if not options['dry_run']:
+            BaseMapping.metadata.create_all(engine)
+        for column in sync_columns(engine, BaseMapping.metadata, dry_run=options['dry_run']):
+            self.stdout.write('{} column {}.{}'.format(
+                'Missing' if options['dry_run'] else 'Added', column.table.name, column.name))
+        for index in sync_indexes(engine, BaseMapping.metadata, dry_run=options['dry_run']):
+            self.stdout.write('{} index {} on {}({})'.format(
+                'Missing' if options['dry_run'] else 'Created',
+                index.name, index.table.name,
+                ', '.join(col.name for col in index.columns)))
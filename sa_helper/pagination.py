@@ -0,0 +1,164 @@
+"""
+Keyset (cursor) pagination for SA queries
+"""
+
+import base64
+import binascii
+import json
+from datetime import datetime
+from uuid import UUID
+
+from sqlalchemy import and_, or_
+from rest_framework.exceptions import ParseError
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+# Naive DateTime columns' keys in cursors
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def _encode_value(value):
+    if isinstance(value, UUID):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.strftime(DATETIME_FORMAT)
+    return value
+
+
+def _decode_value(column, value):
+    """
+    Returns a cursor key as the column's Python type, raises ValueError if
+    it can't be one
+    """
+    python_type = None
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        pass
+    if value is None or python_type not in (UUID, datetime):
+        return value
+    if not isinstance(value, str):
+        raise ValueError
+    if python_type is UUID:
+        return UUID(value)
+    return datetime.strptime(value, DATETIME_FORMAT)
+
+
+class KeysetPagination:
+    """
+    Paginates by a stable, unique ordering instead of OFFSET, so each page
+    costs one index range scan however deep the client pages.
+
+    Pagination is opt-in per request: it's applied only when the client
+    passes the page_size or cursor query param. Cursors are opaque
+    base64-encoded positions, the response body looks like
+    ``{"next": <url>, "previous": <url>, "results": [...]}``.
+    """
+
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    default_page_size = 100
+    max_page_size = 1000
+
+    def __init__(self, ordering):
+        """
+        :param ordering: Columns forming a unique key, e.g. ``(Photo.id,)``
+                         or ``(UploadNotification.created_at, UploadNotification.id)``
+        """
+        self.ordering = tuple(ordering)
+        self.request = None
+        self.next_position = None
+        self.previous_position = None
+
+    def is_requested(self, request):
+        params = request.query_params
+        return self.page_size_query_param in params or self.cursor_query_param in params
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param,
+                                                     self.default_page_size))
+        except ValueError:
+            raise ParseError('Invalid page_size')
+        if page_size < 1:
+            raise ParseError('Invalid page_size')
+        return min(page_size, self.max_page_size)
+
+    def encode_cursor(self, position, reverse):
+        payload = {'k': [_encode_value(v) for v in position], 'r': int(reverse)}
+        data = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        return base64.urlsafe_b64encode(data).decode('ascii')
+
+    def decode_cursor(self, cursor):
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+            values = payload['k']
+            reverse = bool(payload['r'])
+            if len(values) != len(self.ordering):
+                raise ValueError
+            position = tuple(_decode_value(col, v) for col, v in zip(self.ordering, values))
+        except (TypeError, ValueError, KeyError, UnicodeError, binascii.Error):
+            raise ParseError('Invalid cursor')
+        return position, reverse
+
+    def _after(self, position, reverse):
+        """
+        Builds ``ordering > position`` (``<`` when reverse) as nested
+        comparisons, portable to backends without row value support
+        """
+        clauses = []
+        for i, column in enumerate(self.ordering):
+            equal = [self.ordering[j] == position[j] for j in range(i)]
+            compare = column < position[i] if reverse else column > position[i]
+            clauses.append(and_(*(equal + [compare])))
+        return or_(*clauses)
+
+    def _order_by(self, reverse):
+        return [col.desc() if reverse else col.asc() for col in self.ordering]
+
+    def row_position(self, row):
+        return tuple(getattr(row, col.key) for col in self.ordering)
+
+    def paginate_query(self, query, request):
+        self.request = request
+        page_size = self.get_page_size(request)
+        cursor = request.query_params.get(self.cursor_query_param)
+        position, reverse = None, False
+        if cursor:
+            position, reverse = self.decode_cursor(cursor)
+            query = query.filter(self._after(position, reverse))
+
+        rows = query.order_by(*self._order_by(reverse)).limit(page_size + 1).all()
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        if reverse:
+            rows.reverse()
+
+        first = self.row_position(rows[0]) if rows else position
+        last = self.row_position(rows[-1]) if rows else position
+        if reverse:
+            self.next_position = last
+            self.previous_position = first if has_more else None
+        else:
+            self.next_position = last if has_more else None
+            self.previous_position = first if position is not None else None
+        return rows
+
+    def _link(self, position, reverse):
+        if position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param,
+                                   self.encode_cursor(position, reverse))
+
+    def get_next_link(self):
+        return self._link(self.next_position, False)
+
+    def get_previous_link(self):
+        return self._link(self.previous_position, True)
+
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(),
+                         'previous': self.get_previous_link(),
+                         'results': data})
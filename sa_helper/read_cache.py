@@ -0,0 +1,104 @@
+"""
+Generational cache of rendered read responses.
+
+Every model has a collection generation and every object its own one,
+kept in the Django cache. Rendered list responses are cached under the
+collection generation, detail responses under their object's. Writes
+replace the generations, so entries rendered before a write are never hit
+again and expire on their own. Keys don't depend on query param order.
+"""
+
+import hashlib
+from uuid import UUID, uuid4
+
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+
+KEY_PREFIX = 'sa_helper:read'
+# Headers of the rendered response kept with its body
+CACHED_HEADERS = ('Content-Type', 'Vary', 'Allow')
+COLLECTION = '*'
+
+
+def _etag(content):
+    return '"{}"'.format(hashlib.md5(content).hexdigest())
+
+
+class ReadCache:
+
+    def __init__(self, model, timeout):
+        self.model = model
+        self.timeout = timeout
+
+    def _generation_key(self, scope):
+        return '{}:{}:{}:gen'.format(KEY_PREFIX, self.model.__tablename__, scope)
+
+    def _generation(self, scope):
+        key = self._generation_key(scope)
+        generation = cache.get(key)
+        if generation is None:
+            # A fresh token rather than a counter: an evicted generation
+            # never brings back entries rendered under an old one
+            cache.add(key, uuid4().hex, None)
+            generation = cache.get(key) or uuid4().hex
+        return generation
+
+    def entry_key(self, request, pk=None, variant=()):
+        """
+        Returns the cache key of a list (pk None) or retrieve response,
+        None for a malformed pk. variant is what else the representation
+        depends on (see ViewSetModelMixin.get_representation_variant).
+        """
+        if pk is None:
+            scope = COLLECTION
+        else:
+            try:
+                scope = str(UUID(pk))
+            except ValueError:
+                return None
+        variant = repr((request.build_absolute_uri('/'),
+                        request.accepted_media_type,
+                        sorted((name, sorted(values)) for name, values in request.query_params.lists()),
+                        variant))
+        return '{}:{}:{}:{}:{}'.format(KEY_PREFIX, self.model.__tablename__, scope,
+                                       self._generation(scope),
+                                       hashlib.md5(variant.encode('utf-8')).hexdigest())
+
+    def response(self, request, key):
+        """
+        Returns the cached response for key (304 if the client has it), None on a miss
+        """
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        content, headers, etag = entry
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            not_modified['ETag'] = etag
+            return not_modified
+        response = HttpResponse(content)
+        for name, value in headers:
+            response[name] = value
+        response['ETag'] = etag
+        return response
+
+    def store(self, request, key, response):
+        """
+        Renders and caches a DRF response, returns it or 304 if the client has it
+        """
+        response.render()
+        etag = _etag(response.content)
+        headers = [(name, response[name]) for name in CACHED_HEADERS if response.has_header(name)]
+        cache.set(key, (response.content, headers, etag), self.timeout)
+        response['ETag'] = etag
+        return get_conditional_response(request, etag=etag, response=response)
+
+    def invalidate(self, pk=None):
+        """
+        Starts new generations for the collection and the object pk
+        """
+        generations = {self._generation_key(COLLECTION): uuid4().hex}
+        if pk is not None:
+            generations[self._generation_key(str(pk))] = uuid4().hex
+        cache.set_many(generations, None)
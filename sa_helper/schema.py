@@ -0,0 +1,132 @@
+"""
+Schema migration helpers.
+
+metadata.create_all() only creates missing tables, indexes and columns
+declared later on existing tables never reach a live database.
+sync_indexes() diffs the declared indexes against the database and creates
+the missing ones, using CREATE INDEX CONCURRENTLY on PostgreSQL so writes
+aren't blocked. A failed concurrent build leaves an INVALID index behind,
+those count as missing and are dropped before being built again. sync_columns() adds missing nullable columns.
+"""
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex
+
+INVALID_INDEXES = text(
+    'SELECT c.relname FROM pg_index i '
+    'JOIN pg_class c ON c.oid = i.indexrelid '
+    'JOIN pg_namespace n ON n.oid = c.relnamespace '
+    'WHERE NOT i.indisvalid AND n.nspname = current_schema()'
+)
+
+
+def invalid_indexes(engine):
+    """
+    Returns names of indexes left INVALID by failed concurrent builds
+    """
+    if engine.dialect.name != 'postgresql':
+        return set()
+    with engine.connect() as conn:
+        return {row[0] for row in conn.execute(INVALID_INDEXES)}
+
+
+def missing_indexes(engine, metadata):
+    """
+    Yields declared indexes of existing tables which the database lacks or
+    has invalid ones of
+    """
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    invalid = invalid_indexes(engine)
+    for table in metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)} - invalid
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name not in existing:
+                yield index
+
+
+def _drop_index_concurrently(conn, index):
+    preparer = conn.dialect.identifier_preparer
+    name = preparer.quote(index.name)
+    if index.table.schema:
+        name = '{}.{}'.format(preparer.quote_schema(index.table.schema), name)
+    conn.execute('DROP INDEX CONCURRENTLY IF EXISTS {}'.format(name))
+
+
+def create_index(engine, index):
+    """
+    Creates a missing index, concurrently and outside of a transaction on
+    PostgreSQL. There an invalid leftover of the same name is dropped first,
+    and a failed build is dropped again instead of staying INVALID.
+    """
+    if engine.dialect.name == 'postgresql':
+        with engine.connect() as conn:
+            conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+            _drop_index_concurrently(conn, index)
+            index.dialect_kwargs['postgresql_concurrently'] = True
+            try:
+                conn.execute(CreateIndex(index))
+            except Exception:
+                _drop_index_concurrently(conn, index)
+                raise
+            finally:
+                index.dialect_kwargs['postgresql_concurrently'] = False
+    else:
+        index.create(engine)
+
+
+def sync_indexes(engine, metadata, dry_run=False):
+    """
+    Creates missing indexes, returns them
+    """
+    created = []
+    for index in list(missing_indexes(engine, metadata)):
+        if not dry_run:
+            create_index(engine, index)
+        created.append(index)
+    return created
+
+
+def missing_columns(engine, metadata):
+    """
+    Yields declared columns of existing tables which the database lacks
+    """
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    for table in metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                yield column
+
+
+def add_column(engine, column):
+    """
+    Adds a nullable column without a server default, which needs no table
+    rewrite. Other columns can't be added to tables with rows.
+    """
+    if not column.nullable or column.server_default is not None or column.primary_key:
+        raise ValueError('Can only add nullable columns without server default, '
+                         'not {}.{}'.format(column.table.name, column.name))
+    preparer = engine.dialect.identifier_preparer
+    statement = 'ALTER TABLE {} ADD COLUMN {} {}'.format(
+        preparer.format_table(column.table), preparer.format_column(column),
+        column.type.compile(dialect=engine.dialect))
+    with engine.begin() as conn:
+        conn.execute(statement)
+
+
+def sync_columns(engine, metadata, dry_run=False):
+    """
+    Adds missing columns, returns them
+    """
+    added = []
+    for column in list(missing_columns(engine, metadata)):
+        if not dry_run:
+            add_column(engine, column)
+        added.append(column)
+    return added
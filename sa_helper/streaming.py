@@ -0,0 +1,65 @@
+"""
+Streaming list responses: rows are fetched in batches through a server-side
+cursor and serialized one at a time, so peak memory doesn't depend on the
+collection size.
+"""
+
+import json
+
+from django.http import StreamingHttpResponse
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+
+def _dumps(data):
+    return json.dumps(data, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':'))
+
+
+class NDJSONRenderer(BaseRenderer):
+    """
+    Newline delimited JSON, one list element per line
+    """
+    media_type = NDJSON_MEDIA_TYPE
+    format = 'ndjson'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        items = data if isinstance(data, list) else [data]
+        return ''.join(_dumps(item) + '\n' for item in items).encode('utf-8')
+
+
+def iter_query(query, chunk_size):
+    """
+    Iterates the query with a server-side cursor, buffering chunk_size rows
+    """
+    return query.yield_per(chunk_size).execution_options(stream_results=True)
+
+
+def _json_array(rows, to_representation):
+    yield b'['
+    separator = b''
+    for row in rows:
+        yield separator + _dumps(to_representation(row)).encode('utf-8')
+        separator = b','
+    yield b']'
+
+
+def _ndjson_lines(rows, to_representation):
+    for row in rows:
+        yield (_dumps(to_representation(row)) + '\n').encode('utf-8')
+
+
+def streaming_list_response(rows, to_representation, ndjson=False):
+    """
+    Returns a StreamingHttpResponse rendering rows either as a JSON array
+    or as NDJSON
+    """
+    if ndjson:
+        return StreamingHttpResponse(_ndjson_lines(rows, to_representation),
+                                     content_type=NDJSON_MEDIA_TYPE)
+    return StreamingHttpResponse(_json_array(rows, to_representation),
+                                 content_type='application/json')
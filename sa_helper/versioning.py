@@ -0,0 +1,29 @@
+"""
+Row versions for HTTP conditional requests.
+
+Mappings mixing in Versioned get an updated_at column, set on insert and
+by every ORM or Core UPDATE issued through SA. It's nullable so that
+migrate_schema can add it to tables with rows; rows not written since have
+no version until their next update.
+"""
+
+import calendar
+import hashlib
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime
+
+
+class Versioned:
+    updated_at = Column(DateTime, nullable=True, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+def make_etag(*parts):
+    return '"{}"'.format(hashlib.md5(repr(parts).encode('utf-8')).hexdigest())
+
+
+def http_timestamp(value):
+    """
+    Returns seconds since the epoch of a naive UTC datetime
+    """
+    return calendar.timegm(value.utctimetuple())
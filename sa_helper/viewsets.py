@@ -1,10 +1,19 @@
+from collections import OrderedDict
 from uuid import UUID, uuid4
 from rest_framework.response import Response
 from rest_framework.exceptions import NotFound, ParseError
 from rest_framework import status
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from sqlalchemy import func, inspect
 from sqlalchemy.orm import exc
 
 from . import Session
+from .pagination import KeysetPagination
+from .read_cache import ReadCache
+from .read_serializers import CompiledReadSerializer, compile_read_serializer
+from .streaming import NDJSONRenderer, iter_query, streaming_list_response
+from .versioning import http_timestamp, make_etag
 
 class SerializerModelMixin:
     """
@@ -26,13 +35,30 @@ class ViewSetModelMixin:
     Provides CRUD operations implementation via SA backend to DRF's Viewsets
     """
     serializer_class = None
+    pagination_class = KeysetPagination
+    # Unique key for keyset pagination, defaults to (model.id,)
+    ordering = None
+    # Rows fetched per server-side cursor batch in streaming lists
+    stream_chunk_size = 500
+    # Render list rows with the compiled read serializer instead of DRF's field dispatch
+    fast_read = True
+    # Read only the columns serializer_class renders in list/retrieve
+    project_columns = True
+    # Seconds rendered list/retrieve responses stay cached (see ReadCache),
+    # None disables it. Only for reads which don't depend on the user.
+    read_cache_timeout = None
+    # Most ids one ?ids= lookup may ask for
+    max_lookup_ids = 1000
+    # Answer list/retrieve with ETag/Last-Modified from the rows' updated_at
+    # (see versioning.Versioned), 304 before loading rows if unchanged
+    conditional_reads = True
     obj = None
+    _read_cache_key = None
+    _validators = None
 
-    def get_object_or_404(self, pk, **kwargs):
-        sa_session = Session()
+    def _one_or_404(self, query, pk, **kwargs):
         try:
-            query = (sa_session.query(self.serializer_class.model)
-                     .filter(self.serializer_class.model.id == UUID(pk)))
+            query = query.filter(self.serializer_class.model.id == UUID(pk))
             obj = self.apply_qs_filters(query, **kwargs).one()
             return obj
         except ValueError:
@@ -40,6 +66,35 @@ class ViewSetModelMixin:
         except exc.NoResultFound:
             raise NotFound
 
+    def get_object_or_404(self, pk, **kwargs):
+        sa_session = Session()
+        return self._one_or_404(sa_session.query(self.serializer_class.model), pk, **kwargs)
+
+    def get_read_columns(self):
+        """
+        Returns mapped columns serializer_class reads (plus ordering keys),
+        None if it needs full instances
+        """
+        model = self.serializer_class.model
+        names = CompiledReadSerializer.for_class(self.serializer_class).attributes
+        if names is None:
+            return None
+        column_attrs = inspect(model).column_attrs
+        names = names + [col.key for col in self.get_ordering() if col.key not in names]
+        if any(name not in column_attrs for name in names):
+            return None
+        return [getattr(model, name) for name in names]
+
+    def get_read_query(self, sa_session):
+        """
+        Query for read endpoints: lightweight column tuples instead of
+        identity-mapped instances when project_columns is on
+        """
+        columns = self.get_read_columns() if self.project_columns else None
+        if columns is None:
+            return sa_session.query(self.serializer_class.model)
+        return sa_session.query(*columns)
+
     def kwargs_to_validated_data(self, kwargs):
         return kwargs
 
@@ -48,19 +103,212 @@ class ViewSetModelMixin:
 
     def _post_save(self, request):
         if self.obj is not None:
+            self.invalidate_read_cache(self.obj)
             self.post_save(request)
 
     def post_save(self, request):
         pass
 
+    def pre_destroy(self, request):
+        pass
+
+    def post_destroy(self, request):
+        pass
+
+    def get_ordering(self):
+        if self.ordering is not None:
+            return self.ordering
+        return (self.serializer_class.model.id,)
+
+    def get_paginator(self, request):
+        if self.pagination_class is None:
+            return None
+        paginator = self.pagination_class(self.get_ordering())
+        if not paginator.is_requested(request):
+            return None
+        return paginator
+
+    def parse_lookup_ids(self, value):
+        """
+        Returns distinct UUIDs of a comma separated string or a list, in
+        their order
+        """
+        if isinstance(value, str):
+            value = [item for item in value.split(',') if item]
+        if not isinstance(value, list):
+            raise ParseError('ids must be a list')
+        if len(value) > self.max_lookup_ids:
+            raise ParseError('At most {} ids per request'.format(self.max_lookup_ids))
+        try:
+            ids = [UUID(str(item)) for item in value]
+        except ValueError:
+            raise ParseError('Invalid id')
+        return list(OrderedDict.fromkeys(ids))
+
+    def get_lookup_ids(self, request):
+        """
+        Returns ids of the ?ids= query param, None if not given
+        """
+        value = request.query_params.get('ids')
+        if value is None:
+            return None
+        return self.parse_lookup_ids(value)
+
+    def lookup_list(self, request, queryset, ids):
+        """
+        Renders rows of ids in their order with one IN query, skipping missing ones
+        """
+        if not ids:
+            return Response([])
+        rows = queryset.filter(self.serializer_class.model.id.in_(ids)).all()
+        position = {pk: i for i, pk in enumerate(ids)}
+        rows.sort(key=lambda row: position[row.id])
+        to_representation = self.get_row_representation(request)
+        return Response([to_representation(row) for row in rows])
+
+    def get_representation_variant(self, request):
+        """
+        Returns what else than the URL and the negotiated renderer the
+        representation depends on, e.g. image types picked from the Accept
+        header. Part of ETags and read cache keys.
+        """
+        return ()
+
+    def _validator_variant(self, request):
+        return (request.build_absolute_uri('/'), request.accepted_media_type,
+                sorted((name, sorted(values)) for name, values in request.query_params.lists()),
+                self.get_representation_variant(request))
+
+    def is_conditional_read(self, request):
+        return self.conditional_reads and hasattr(self.serializer_class.model, 'updated_at')
+
+    def get_list_validators(self, request, **kwargs):
+        """
+        Returns (etag, None) of the filtered collection from its max
+        updated_at and row count, None if the model has no updated_at. No
+        Last-Modified: deleting a row doesn't change the max.
+        """
+        if not self.is_conditional_read(request):
+            return None
+        model = self.serializer_class.model
+        query = (Session().query(func.max(model.updated_at), func.count(model.id))
+                          .select_from(model))
+        latest, count = self.apply_qs_filters(query, **kwargs).one()
+        return make_etag(model.__tablename__, latest, count, self._validator_variant(request)), None
+
+    def get_object_validators(self, request, pk, **kwargs):
+        """
+        Returns (etag, last modified timestamp) of one row, None if it has no version
+        """
+        if not self.is_conditional_read(request):
+            return None
+        model = self.serializer_class.model
+        updated_at, = self._one_or_404(Session().query(model.updated_at), pk, **kwargs)
+        if updated_at is None:
+            return None
+        return (make_etag(model.__tablename__, pk, updated_at, self._validator_variant(request)),
+                http_timestamp(updated_at))
+
+    def not_modified(self, request, validators):
+        """
+        Returns 304 if the client's copy matches validators, None otherwise.
+        Validators are added to the final response.
+        """
+        if validators is None:
+            return None
+        self._validators = validators
+        etag, last_modified = validators
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            self._set_validators(response)
+        return response
+
+    def _set_validators(self, response):
+        etag, last_modified = self._validators
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+
+    def get_read_cache(self):
+        if self.read_cache_timeout is None:
+            return None
+        return ReadCache(self.serializer_class.model, self.read_cache_timeout)
+
+    def cached_read(self, request, pk=None):
+        """
+        Returns the cached response of a list (pk None) or retrieve request,
+        on a miss remembers where finalize_response caches the rendered one
+        """
+        read_cache = self.get_read_cache()
+        if read_cache is None or self.is_streaming_requested(request):
+            return None
+        key = read_cache.entry_key(request, pk, self.get_representation_variant(request))
+        if key is None:
+            return None
+        response = read_cache.response(request, key)
+        if response is None:
+            self._read_cache_key = key
+        return response
+
+    def invalidate_read_cache(self, obj):
+        read_cache = self.get_read_cache()
+        if read_cache is not None:
+            read_cache.invalidate(obj.id)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        # Representations depend on Accept beyond the renderer (see
+        # get_representation_variant), also when only one renderer is left
+        patch_vary_headers(response, ('Accept',))
+        if self._validators is not None and response.status_code == status.HTTP_200_OK:
+            self._set_validators(response)
+        if (self._read_cache_key is not None and isinstance(response, Response)
+                and response.status_code == status.HTTP_200_OK):
+            response = self.get_read_cache().store(request, self._read_cache_key, response)
+        return response
+
+    def get_renderers(self):
+        return super().get_renderers() + [NDJSONRenderer()]
+
+    def is_streaming_requested(self, request):
+        return (request.query_params.get('stream') in ('1', 'true')
+                or request.accepted_renderer.format == NDJSONRenderer.format)
+
+    def get_row_representation(self, request):
+        """
+        Returns a function rendering one row the way serializer_class does
+        """
+        context = {'request': request}
+        if self.fast_read:
+            return compile_read_serializer(self.serializer_class, context)
+        return self.serializer_class(context=context).to_representation
+
+    def stream_list(self, request, queryset):
+        return streaming_list_response(
+            iter_query(queryset, self.stream_chunk_size),
+            self.get_row_representation(request),
+            ndjson=request.accepted_renderer.format == NDJSONRenderer.format)
+
     def list(self, request, **kwargs):
+        cached = self.cached_read(request)
+        if cached is not None:
+            return cached
+        not_modified = self.not_modified(request, self.get_list_validators(request, **kwargs))
+        if not_modified is not None:
+            return not_modified
         sa_session = Session()
-        queryset = sa_session.query(self.serializer_class.model)
-        serializer = self.serializer_class(
-            self.apply_qs_filters(queryset, **kwargs),
-            many=True,
-            context={'request': request})
-        return Response(serializer.data)
+        queryset = self.apply_qs_filters(self.get_read_query(sa_session), **kwargs)
+        ids = self.get_lookup_ids(request)
+        if ids is not None:
+            return self.lookup_list(request, queryset, ids)
+        if self.is_streaming_requested(request):
+            return self.stream_list(request, queryset)
+        to_representation = self.get_row_representation(request)
+        paginator = self.get_paginator(request)
+        if paginator is not None:
+            page = paginator.paginate_query(queryset, request)
+            return paginator.get_paginated_response([to_representation(row) for row in page])
+        return Response([to_representation(row) for row in queryset])
     
     def create(self, request, **kwargs):
         sa_session = Session()
@@ -70,15 +318,22 @@ class ViewSetModelMixin:
             sa_session.add(self.obj)
             try:
                 sa_session.commit()
-                self._post_save(request)
             except Exception as e:
                 sa_session.rollback()
                 return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            # Committed, hook failures mustn't be reported as a rolled back write
+            self._post_save(request)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
     def retrieve(self, request, pk=None, **kwargs):
-        self.obj = self.get_object_or_404(pk, **kwargs)
+        cached = self.cached_read(request, pk)
+        if cached is not None:
+            return cached
+        not_modified = self.not_modified(request, self.get_object_validators(request, pk, **kwargs))
+        if not_modified is not None:
+            return not_modified
+        self.obj = self._one_or_404(self.get_read_query(Session()), pk, **kwargs)
         return Response(self.serializer_class(self.obj,  context={'request': request}).data)
     
     def _update(self, request, pk, partial=False, **kwargs):
@@ -93,11 +348,11 @@ class ViewSetModelMixin:
             sa_session = Session()
             try:
                 sa_session.commit()
-                self._post_save(request)
-                return Response(serializer.data, status=status.HTTP_200_OK)
             except Exception as e:
                 sa_session.rollback()
                 return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            self._post_save(request)
+            return Response(serializer.data, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
     def update(self, request, pk=None, **kwargs):
@@ -108,11 +363,14 @@ class ViewSetModelMixin:
 
     def destroy(self, request, pk=None, **kwargs):
         self.obj = self.get_object_or_404(pk, **kwargs)
+        self.pre_destroy(request)
         sa_session = Session()
         sa_session.delete(self.obj)
         try:
             sa_session.commit()
-            return Response(status=status.HTTP_204_NO_CONTENT)
         except Exception:
             sa_session.rollback()
             return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.invalidate_read_cache(self.obj)
+        self.post_destroy(request)
+        return Response(status=status.HTTP_204_NO_CONTENT)